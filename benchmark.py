@@ -0,0 +1,354 @@
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import configparser
+import multiprocessing
+from contextlib import redirect_stdout
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import records
+from sqlalchemy import event
+
+import gw2api
+import db
+import metrics
+import plan
+import profit
+import recipescan
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+item_count = config['benchmark'].getint('items')
+recipe_count = config['benchmark'].getint('recipes')
+scan_sample = config['benchmark'].getint('scan_sample')
+seed = config['benchmark'].getint('seed')
+fixture_path = config['benchmark']['fixture']
+record_fixture = config['benchmark'].getboolean('record_fixture')
+output_path = config['benchmark']['output']
+baseline_path = config['benchmark']['baseline']
+tolerance = config['benchmark'].getfloat('tolerance')
+memory_pass = config['benchmark'].getboolean('memory_pass')
+
+server_data = None      # the dataset the stand-in server answers from, set in the server process
+
+
+def synthetic_dataset(item_count, recipe_count, seed=0):
+    # items, recipes and trading post prices shaped like the real api's. ids are sparse like the game's, a quarter
+    # of the items are raw materials that recipes draw from, and about a third of all ingredients are the output of
+    # another recipe so there are crafting trees several levels deep to expand.
+    generator = random.Random(seed)
+    item_id_list = sorted(generator.sample(range(1, 2 * item_count), item_count))
+    material_id_list = item_id_list[:item_count // 4]
+    craftable_id_list = item_id_list[item_count // 4:]
+
+    item_list = []
+    for item_id in item_id_list:
+        flags = []
+        if generator.random() < 0.15:
+            flags.append(generator.choice(['AccountBound', 'SoulbindOnAcquire']))
+        if generator.random() < 0.05:
+            flags.append('NoSell')
+        item_list.append({
+            'id': item_id, 'name': 'Item {item_id}'.format(item_id=item_id), 'type': 'CraftingMaterial',
+            'rarity': generator.choice(['Basic', 'Fine', 'Masterwork', 'Rare']), 'level': generator.randint(0, 80),
+            'vendor_value': generator.randint(0, 200), 'flags': flags
+        })
+
+    recipe_list = []
+    output_id_list = []
+    for output_item_id in sorted(generator.sample(craftable_id_list, recipe_count)):
+        ingredient_dict = {}
+        for ingredient_number in range(generator.randint(1, 4)):
+            if output_id_list and generator.random() < 0.35:
+                ingredient_id = generator.choice(output_id_list)
+            else:
+                ingredient_id = generator.choice(material_id_list)
+            ingredient_dict[ingredient_id] = generator.choice([1, 1, 2, 3, 5, 10, 25, 50])
+
+        recipe_dict = {
+            'id': len(recipe_list) + 1, 'type': 'Refinement', 'output_item_id': output_item_id,
+            'output_item_count': generator.choice([1, 1, 1, 2, 5, 10]), 'time_to_craft_ms': generator.choice([1000, 2000, 5000]),
+            'disciplines': [generator.choice(['Armorsmith', 'Artificer', 'Chef', 'Huntsman', 'Jeweler', 'Leatherworker', 'Tailor', 'Weaponsmith'])],
+            'min_rating': generator.randint(0, 500), 'flags': ['LearnedFromItem'] if generator.random() < 0.2 else ['AutoLearned'],
+            'ingredients': [{'item_id': item_id, 'count': count} for item_id, count in ingredient_dict.items()]
+        }
+        recipe_list.append(recipe_dict)
+        output_id_list.append(output_item_id)
+
+        # the same recipe under another discipline, which the loaders have to recognise as a duplicate.
+        if generator.random() < 0.05:
+            recipe_list.append(dict(recipe_dict, id=len(recipe_list) + 1, disciplines=['Chef']))
+
+    price_list = []
+    for item_dict in item_list:
+        if 'AccountBound' in item_dict['flags'] or 'SoulbindOnAcquire' in item_dict['flags'] or generator.random() < 0.1:
+            continue
+        buy_price = generator.randint(1, 50000)
+        price_list.append({
+            'id': item_dict['id'], 'whitelisted': False,
+            'buys': {'quantity': generator.randint(0, 100000), 'unit_price': buy_price},
+            'sells': {'quantity': generator.randint(0, 100000), 'unit_price': buy_price + generator.randint(1, buy_price // 5 + 1)}
+        })
+
+    return {'items': item_list, 'recipes': recipe_list, 'prices': price_list}
+
+
+def record_dataset():
+    # pulls every item, recipe and price from the live api into the same shape as synthetic_dataset.
+    dataset = {}
+    for key, list_endpoint, bulk_endpoint in (('items', 'item_details', 'multi_item'), ('recipes', 'recipe_details', 'multi_recipe'),
+                                              ('prices', 'item_pricing', 'multi_pricing'), ('listings', 'item_pricing', 'multi_listings')):
+        id_list = gw2api.get_json(payload='', endpoint=list_endpoint, default=[])
+        dataset[key] = []
+        for chunk, result_list in gw2api.get_json_chunks(chunks=gw2api.chunk_list(id_list), endpoint=bulk_endpoint, default=[]):
+            dataset[key].extend(result_list)
+
+    return dataset
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # answers the endpoints gw2api.build_url produces from server_data, the way the real api does: bulk requests
+    # with some unknown ids are a 206, with none known a 404.
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with server_data['request_count'].get_lock():
+            server_data['request_count'].value += 1
+
+        url = urlparse(self.path)
+        query_dict = parse_qs(url.query)
+        path = url.path.rstrip('/')
+
+        if path == '/v2/recipes/search':
+            if 'output' in query_dict:
+                self.send_json(server_data['recipes_by_output'].get(int(query_dict['output'][0]), []))
+            else:
+                self.send_json(server_data['recipes_by_input'].get(int(query_dict['input'][0]), []))
+            return
+
+        endpoint_dict = {'/v2/items': 'items', '/v2/recipes': 'recipes', '/v2/commerce/prices': 'prices', '/v2/commerce/listings': 'listings'}
+        parent_path, last_part = path.rsplit('/', 1)
+        if path in endpoint_dict and 'ids' in query_dict:
+            by_id = server_data[endpoint_dict[path]]
+            id_list = [int(part) for part in query_dict['ids'][0].split(',') if part]
+            result_list = [by_id[result_id] for result_id in id_list if result_id in by_id]
+            if not result_list:
+                self.send_json({'text': 'all ids provided are invalid'}, status=404)
+            else:
+                self.send_json(result_list, status=200 if len(result_list) == len(id_list) else 206)
+        elif path in endpoint_dict:
+            self.send_json(list(server_data[endpoint_dict[path]]))
+        elif parent_path in endpoint_dict and last_part.isdigit():
+            result = server_data[endpoint_dict[parent_path]].get(int(last_part))
+            if result is None:
+                self.send_json({'text': 'no such id'}, status=404)
+            else:
+                self.send_json(result)
+        else:
+            self.send_json({'text': 'not found'}, status=404)
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(dataset, request_count, port_queue):
+    # runs in its own process so the server doesn't compete with the code being timed for the gil.
+    global server_data
+    recipes_by_output = {}
+    recipes_by_input = {}
+    for recipe_dict in dataset['recipes']:
+        recipes_by_output.setdefault(recipe_dict['output_item_id'], []).append(recipe_dict['id'])
+        for ingredient in recipe_dict['ingredients']:
+            recipes_by_input.setdefault(ingredient['item_id'], []).append(recipe_dict['id'])
+
+    # order books five levels deep either side of the top of book, unless the dataset came with real ones.
+    listings_list = dataset.get('listings') or [
+        {'id': price_dict['id'],
+         'buys': [{'listings': 1, 'unit_price': max(1, price_dict['buys']['unit_price'] - level * 3), 'quantity': 25 * (level + 1)} for level in range(5)],
+         'sells': [{'listings': 1, 'unit_price': price_dict['sells']['unit_price'] + level * 3, 'quantity': 25 * (level + 1)} for level in range(5)]}
+        for price_dict in dataset['prices']
+    ]
+
+    server_data = {
+        'items': {item_dict['id']: item_dict for item_dict in dataset['items']},
+        'listings': {listings_dict['id']: listings_dict for listings_dict in listings_list},
+        'recipes': {recipe_dict['id']: recipe_dict for recipe_dict in dataset['recipes']},
+        'prices': {price_dict['id']: price_dict for price_dict in dataset['prices']},
+        'recipes_by_output': recipes_by_output, 'recipes_by_input': recipes_by_input, 'request_count': request_count
+    }
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(dataset):
+    request_count = multiprocessing.Value('i', 0)
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=serve, args=(dataset, request_count, port_queue), daemon=True)
+    server_process.start()
+    return server_process, request_count, 'http://127.0.0.1:{port}'.format(port=port_queue.get())
+
+
+def point_at(server_url, work_directory):
+    # sends every api call to the stand-in with no rate limit, through an empty cache, into an empty database.
+    gw2api.base_url = server_url
+    gw2api.requests_per_second = 0
+    gw2api.cache_path = os.path.join(work_directory, 'api_cache.db')
+    gw2api.cache_db = None
+    gw2api.memory_cache.clear()
+
+    db.db = records.Database(db_url='sqlite:///' + os.path.join(work_directory, 'benchmark.db'))
+    db.verbose = False
+    db.apply_storage_profile()
+    metrics.watch_engine(db.db._engine)
+    metrics.reset()
+
+
+def run_stages(request_count, stage_list, trace_memory=False):
+    # times each (name, function) in turn. returns a dict of name: wall time, requests and statements, plus peak
+    # memory with trace_memory. tracemalloc slows python-heavy stages several times over, so those wall times aren't
+    # comparable with untraced ones.
+    statement_count = [0]
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statement_count[0] += 1
+
+    event.listen(db.db._engine, 'before_cursor_execute', count_statement)
+    if trace_memory:
+        tracemalloc.start()
+    result_dict = {}
+    for name, function in stage_list:
+        requests_before = request_count.value
+        statements_before = statement_count[0]
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            function()
+        result_dict[name] = {
+            'wall_time': time.perf_counter() - start_time,
+            'requests': request_count.value - requests_before,
+            'statements': statement_count[0] - statements_before
+        }
+        if trace_memory:
+            result_dict[name]['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    if trace_memory:
+        tracemalloc.stop()
+
+    return result_dict
+
+
+def run_pass(dataset, trace_memory=False):
+    # one full build and scan against a fresh stand-in server, cache and database.
+    server_process, request_count, server_url = start_server(dataset)
+    with tempfile.TemporaryDirectory() as work_directory:
+        point_at(server_url=server_url, work_directory=work_directory)
+        result_dict = run_stages(request_count=request_count, stage_list=build_and_scan(), trace_memory=trace_memory)
+        db.db.close()
+        gw2api.cache_db.close()
+    server_process.terminate()
+
+    return result_dict
+
+
+def scan_recipes():
+    recipe_id_list = gw2api.get_json(payload='', endpoint='recipe_details', default=[])[:scan_sample]
+    recipescan.get_profitable_recipes(recipe_id_list, min_profit=0, workers=1)
+
+
+def build_and_scan():
+    def build_items():
+        db.init_items()
+        db.populate_items()
+
+    def build_recipes():
+        db.init_recipes()
+        db.populate_recipe_table()
+        db.init_views()
+
+    stage_list = [
+        ('populate_items', build_items),
+        ('trading_post_pricing', db.trading_post_pricing),
+        ('populate_recipe_table', build_recipes),
+        ('alternate_recipes', db.alternate_recipes),
+        ('rescore_recipes', profit.rescore_recipes),
+        ('order_book_pricing', db.order_book_pricing),
+        ('craft_plan', plan.plan_crafts),
+        ('recipescan', scan_recipes),
+    ]
+    return stage_list
+
+
+def print_report(result_dict):
+    print('{:<24}{:>12}{:>12}{:>12}{:>14}'.format('stage', 'seconds', 'requests', 'statements', 'peak MiB'))
+    for name, stage_dict in result_dict.items():
+        print('{:<24}{:>12.3f}{:>12}{:>12}{:>14}'.format(
+            name, stage_dict['wall_time'], stage_dict['requests'], stage_dict['statements'],
+            '{:.1f}'.format(stage_dict['peak_memory'] / 2 ** 20) if 'peak_memory' in stage_dict else '-'
+        ))
+
+
+def compare_to_baseline(result_dict, baseline_dict):
+    # returns a line for every measurement more than tolerance worse than the baseline.
+    regression_list = []
+    for name, stage_dict in result_dict.items():
+        for measurement, value in stage_dict.items():
+            baseline_value = baseline_dict.get(name, {}).get(measurement)
+            if baseline_value is not None and value > baseline_value * (1 + tolerance):
+                regression_list.append('{name} {measurement}: {value} against {baseline}'.format(
+                    name=name, measurement=measurement, value=value, baseline=baseline_value
+                ))
+
+    return regression_list
+
+
+def main():
+    if record_fixture:
+        with open(fixture_path, 'w') as fixture_file:
+            json.dump(record_dataset(), fixture_file)
+
+    if fixture_path and os.path.exists(fixture_path):
+        with open(fixture_path) as fixture_file:
+            dataset = json.load(fixture_file)
+    else:
+        dataset = synthetic_dataset(item_count=item_count, recipe_count=recipe_count, seed=seed)
+    print('{items} items, {recipes} recipes, {prices} prices'.format(
+        items=len(dataset['items']), recipes=len(dataset['recipes']), prices=len(dataset['prices'])
+    ))
+
+    result_dict = run_pass(dataset)
+    metrics.export()
+    if memory_pass:
+        # peak memory comes from a second, traced pass so the timed one runs at full speed.
+        for name, stage_dict in run_pass(dataset, trace_memory=True).items():
+            result_dict[name]['peak_memory'] = stage_dict['peak_memory']
+
+    print_report(result_dict)
+    if output_path:
+        with open(output_path, 'w') as output_file:
+            json.dump(result_dict, output_file, indent=2)
+
+    if baseline_path:
+        with open(baseline_path) as baseline_file:
+            regression_list = compare_to_baseline(result_dict, json.load(baseline_file))
+        for regression in regression_list:
+            print('regression - ' + regression)
+        if regression_list:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
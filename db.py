@@ -1,10 +1,15 @@
 
+import sys
 import pickle
 import configparser
+from array import array
+from bisect import bisect_left
 from collections import Counter
 
 import records
-import requests
+
+import gw2api
+import metrics
 
 config = configparser.ConfigParser()
 config.read('config.ini')
@@ -13,9 +18,19 @@ karma_conversion = config['db_only']['karma_conversion']
 init_items_flag = config['db_only'].getboolean('init_items_flag')
 init_recipes_flag = config['db_only'].getboolean('init_items_flag')
 add_alt_recipes = config['db_only'].getboolean('add_alt_recipes')
+build_retries = config['db_only'].getint('build_retries')
+alt_recipe_depth = config['db_only'].getint('alt_recipe_depth')
+fully_expanded_depth = 2 ** 31 - 1     # expansion_depth of altered recipes migrated from before depths were tracked
+alt_recipe_pruning = config['db_only']['alt_recipe_pruning']
+tp_tradable_only = config['db_only'].getboolean('tp_tradable_only')
+tp_recipe_items_only = config['db_only'].getboolean('tp_recipe_items_only')
+depth_pricing = config['db_only'].getboolean('depth_pricing')
+craft_plan = config['db_only'].getboolean('craft_plan')
 verbose = config['all_files'].getboolean('verbose')
 db_url = config['all_files']['db_url']
+storage = config['storage']
 db = records.Database(db_url=db_url)
+metrics.watch_engine(db._engine)
 
 
 def base36encode(number):
@@ -81,44 +96,106 @@ def combine_dict_list_to_string(list_of_dict_lists, item_to_remove=None):
     return component_string
 
 
-def api_query(payload, endpoint, default=None):
+max_component_count = 2 ** 32 - 1    # largest count or output quantity a packed recipe can hold
 
-    if endpoint == 'recipes_output':
-        url = "https://api.guildwars2.com/v2/recipes/search?output={}".format(payload)
-    elif endpoint == 'recipes_input':
-        url = "https://api.guildwars2.com/v2/recipes/search?input={}".format(payload)
-    elif endpoint == 'recipe_details':
-        url = "https://api.guildwars2.com/v2/recipes/{}".format(payload)
-    elif endpoint == 'api_recipes':
-        url = "https://api.guildwars2.com/v2/recipes?access_token={}".format(payload)
-    elif endpoint == 'item_details':
-        url = "https://api.guildwars2.com/v2/items/{}".format(payload)
-    elif endpoint == 'item_pricing':
-        url = "https://api.guildwars2.com/v2/commerce/prices/{}".format(payload)
-    elif endpoint == 'multi_item':
-        assert isinstance(payload, (list, tuple))
-        list_string = str(payload)[1:-1].replace(' ', '')    # strips '[' and ']' from str representation.
-        url = "https://api.guildwars2.com/v2/items?ids={}".format(list_string)
-    elif endpoint == 'multi_recipe':
-        assert isinstance(payload, (list, tuple))
-        list_string = str(payload)[1:-1].replace(' ', '')    # strips '[' and ']' from str representation.
-        url = "https://api.guildwars2.com/v2/recipes?ids={}".format(list_string)
-    elif endpoint == 'multi_pricing':
-        assert isinstance(payload, (list, tuple))
-        list_string = str(payload)[1:-1].replace(' ', '')    # strips '[' and ']' from str representation.
-        url = "https://api.guildwars2.com/v2/commerce/prices?ids={}".format(list_string)
+# blobs are stored little endian whatever the host, 'I' is 4 bytes on every platform python builds on.
+if array('I').itemsize != 4:
+    raise ImportError('db.py needs a 4 byte array typecode I, this platform has {size}'.format(size=array('I').itemsize))
+native_little_endian = sys.byteorder == 'little'
 
-    else:
-        assert False
 
-    result = requests.get(url=url)
-    try:
-        result.raise_for_status()
-        result_list_or_dict = result.json()
-    except requests.exceptions.HTTPError:
-        result_list_or_dict = default
+def uint32_bytes(value_list):
+    # little endian uint32 bytes of a list (or array) of ints.
+    values = array('I', value_list)
+    if not native_little_endian:
+        values.byteswap()
+    return values.tobytes()
+
+
+def uint32_view(blob):
+    # uint32 values of little endian bytes, a zero copy view on little endian hosts.
+    if native_little_endian:
+        return memoryview(blob).cast('I')
+    values = array('I', bytes(blob))
+    values.byteswap()
+    return values
+
+
+def pack_components(component_dict_list):
+    # packed form of an ingredient list: every item id as a uint32, then every count as a uint32, sorted by item id.
+    # sorted means equal ingredient lists always pack to the same bytes, and two lists merge in one linear pass.
+    ingredients = Counter()
+    for ingredient in component_dict_list:
+        ingredients[ingredient['item_id']] += ingredient['count']
+
+    item_id_list = sorted(ingredients)
+    return uint32_bytes(item_id_list) + uint32_bytes([ingredients[item_id] for item_id in item_id_list])
+
+
+def unpack_components(component_blob):
+    # views over the packed item ids and counts, zero copy on little endian hosts.
+    view = memoryview(component_blob)
+    half = len(view) // 2
+    return uint32_view(view[:half]), uint32_view(view[half:])
+
+
+def blob_to_component_string(component_blob):
+    item_ids, counts = unpack_components(component_blob)
+    return ''.join(component_to_string(item_id=item_id, count=count) for item_id, count in zip(item_ids, counts))
+
+
+def merge_components(first_blob, first_multiplier, second_blob, second_multiplier, item_to_remove=None):
+    # first * first_multiplier + second * second_multiplier, without item_to_remove, as a packed blob.
+    # None if any count comes to more than a packed count can hold.
+    first_ids, first_counts = unpack_components(first_blob)
+    second_ids, second_counts = unpack_components(second_blob)
+    merged_ids = array('I')
+    merged_counts = array('I')
+
+    first_position = second_position = 0
+    while first_position < len(first_ids) or second_position < len(second_ids):
+        if second_position == len(second_ids) or (first_position < len(first_ids) and first_ids[first_position] < second_ids[second_position]):
+            item_id = first_ids[first_position]
+            count = first_counts[first_position] * first_multiplier
+            first_position += 1
+        elif first_position == len(first_ids) or second_ids[second_position] < first_ids[first_position]:
+            item_id = second_ids[second_position]
+            count = second_counts[second_position] * second_multiplier
+            second_position += 1
+        else:
+            item_id = first_ids[first_position]
+            count = first_counts[first_position] * first_multiplier + second_counts[second_position] * second_multiplier
+            first_position += 1
+            second_position += 1
+
+        if item_id != item_to_remove:
+            if count > max_component_count:
+                return None
+            merged_ids.append(item_id)
+            merged_counts.append(count)
 
-    return result_list_or_dict
+    return uint32_bytes(merged_ids) + uint32_bytes(merged_counts)
+
+
+def component_count(component_blob, item_id):
+    item_ids, counts = unpack_components(component_blob)
+    position = bisect_left(item_ids, item_id)
+    if position < len(item_ids) and item_ids[position] == item_id:
+        return counts[position]
+    return 0
+
+
+def recipe_content_hash(output_item, output_quantity, component_blob):
+    # canonical identity of a recipe, the blob is already sorted so ingredient order doesn't matter.
+    from hashlib import blake2b
+    id_hash = blake2b(digest_size=8)
+    id_hash.update(uint32_bytes([output_item, output_quantity]))
+    id_hash.update(component_blob)
+    return int.from_bytes(id_hash.digest(), byteorder='big', signed=True)
+
+
+def api_query(payload, endpoint, default=None):
+    return gw2api.get_json(payload=payload, endpoint=endpoint, default=default)
 
 
 def init_items():
@@ -137,6 +214,7 @@ def init_items():
     tp_value INTEGER DEFAULT 0
 );""")
     db.query(query="INSERT INTO ITEMS (item_id, vendor_cost, karma_cost, vendor_value, bound, tp_cost, tp_value) VALUES (0, 0, 0, 0, 0, 0, 0);")
+    clear_checkpoint(stage='items')
 
 
 def init_recipes():
@@ -151,54 +229,338 @@ def init_recipes():
     needs_recipe INTEGER,
     output_item INTEGER NOT NULL,
     output_quantity INTEGER NOT NULL,
-    component_string TEXT NOT NULL
+    component_string TEXT NOT NULL,
+    component_blob BLOB NOT NULL,
+    content_hash INTEGER NOT NULL,
+    expansion_depth INTEGER NOT NULL DEFAULT 0,
+    disciplines TEXT,
+    time_to_craft_ms INTEGER
 );"""
     db.query(query=initialise)
+    db.query(query='CREATE UNIQUE INDEX recipes_content_hash ON recipes (content_hash);')
+    db.query(query='PRAGMA user_version = 1;')     # disciplines are stored as steps, see discipline_steps
+    init_recipe_ingredients()
+    db.query(query='DROP TABLE IF EXISTS recipe_variants;')
+    init_recipe_variants()
+    clear_checkpoint(stage='recipes')
+
+
+def init_recipe_variants():
+    # game ids of discipline variants that were merged into an identical recipe kept under another game id.
+    db.query(query="""CREATE TABLE IF NOT EXISTS recipe_variants (
+    game_id INTEGER PRIMARY KEY,
+    content_hash INTEGER NOT NULL
+);""")
+
+
+def init_checkpoints():
+    # ids each build stage has committed, so an interrupted build picks up where it stopped.
+    db.query(query="""CREATE TABLE IF NOT EXISTS build_checkpoints (
+    stage TEXT NOT NULL,
+    item_id INTEGER NOT NULL,
+    PRIMARY KEY (stage, item_id)
+);""")
+
+
+def checkpoint_ids(stage):
+    init_checkpoints()
+    return set(row[0] for row in db.query('SELECT item_id FROM build_checkpoints WHERE stage = :stage;', stage=stage).all())
+
+
+def checkpoint_started(stage):
+    init_checkpoints()
+    return bool(db.query('SELECT 1 FROM build_checkpoints WHERE stage = :stage LIMIT 1;', stage=stage).all())
+
+
+def record_checkpoint(stage, id_list):
+    # call inside the transaction that commits the ids' rows, so the checkpoint never runs ahead of the data.
+    if id_list:
+        db.bulk_query(
+            'INSERT OR IGNORE INTO build_checkpoints (stage, item_id) VALUES (:stage, :item_id);',
+            [{'stage': stage, 'item_id': item_id} for item_id in id_list]
+        )
+
+
+def clear_checkpoint(stage):
+    init_checkpoints()
+    db.query('DELETE FROM build_checkpoints WHERE stage = :stage;', stage=stage)
+
+
+def init_recipe_ingredients():
+    # one row per ingredient of every recipe, so consumers of an item can be found through an index instead of a LIKE scan.
+    db.query(query='DROP TABLE IF EXISTS recipe_ingredients;')
+    db.query(query="""CREATE TABLE recipe_ingredients (
+    unique_id INTEGER NOT NULL,
+    item_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (unique_id, item_id)
+);""")
+    db.query(query='CREATE INDEX recipe_ingredients_item_id ON recipe_ingredients (item_id);')
+    db.query(query='CREATE INDEX IF NOT EXISTS recipes_output_item ON recipes (output_item);')
+
+
+def index_recipe_ingredients():
+    # rebuilds recipe_ingredients from component_string, for databases created before the table existed.
+    if verbose:
+        print('indexing recipe ingredients')
+
+    init_recipe_ingredients()
+    recipe_result_dict_list = db.query('SELECT unique_id, component_string FROM recipes;').as_dict()
+    ingredient_row_list = []
+    for recipe_dict in recipe_result_dict_list:
+        for ingredient in string_to_component_dict_list(recipe_dict['component_string']):
+            ingredient_row_list.append({'unique_id': recipe_dict['unique_id'], 'item_id': ingredient['item_id'], 'count': ingredient['count']})
+
+    if ingredient_row_list:
+        with db.transaction():
+            db.bulk_query('INSERT INTO recipe_ingredients (unique_id, item_id, count) VALUES (:unique_id, :item_id, :count);', ingredient_row_list)
+
+
+@metrics.timed_stage
+def migrate_component_blobs():
+    # databases from before component_blob existed get the column added and filled from component_string.
+    column_list = [column['name'] for column in db.query('PRAGMA table_info(recipes);').as_dict()]
+    if 'component_blob' not in column_list:
+        db.query('ALTER TABLE recipes ADD COLUMN component_blob BLOB;')
+
+    recipe_row_list = db.query('SELECT unique_id, component_string FROM recipes WHERE component_blob IS NULL;').as_dict()
+    if verbose and recipe_row_list:
+        print('packing {count} component strings'.format(count=len(recipe_row_list)))
+
+    blob_row_list = [
+        {'unique_id': recipe_row['unique_id'], 'component_blob': pack_components(string_to_component_dict_list(recipe_row['component_string']))}
+        for recipe_row in recipe_row_list
+    ]
+    for blob_row_chunk in gw2api.chunk_list(blob_row_list, size=10000):
+        with db.transaction():
+            db.bulk_query('UPDATE recipes SET component_blob = :component_blob WHERE unique_id = :unique_id;', blob_row_chunk)
+
+
+@metrics.timed_stage
+def migrate_content_hashes():
+    # databases from before content_hash existed get the column filled, duplicates dropped and the unique index built.
+    # of each set of duplicates the base recipe with the lowest game_id is kept.
+    column_list = [column['name'] for column in db.query('PRAGMA table_info(recipes);').as_dict()]
+    if 'content_hash' not in column_list:
+        db.query('ALTER TABLE recipes ADD COLUMN content_hash INTEGER;')
+
+    recipe_row_list = db.query("""SELECT unique_id, output_item, output_quantity, component_blob FROM recipes
+    WHERE content_hash IS NULL ORDER BY is_altered ASC, game_id ASC;""").as_dict()
+    if not recipe_row_list:
+        db.query('CREATE UNIQUE INDEX IF NOT EXISTS recipes_content_hash ON recipes (content_hash);')
+        return
+    if verbose:
+        print('hashing {count} recipes'.format(count=len(recipe_row_list)))
+
+    seen_hashes = set(row[0] for row in db.query('SELECT content_hash FROM recipes WHERE content_hash IS NOT NULL;').all())
+    hash_row_list = []
+    duplicate_row_list = []
+    for recipe_row in recipe_row_list:
+        content_hash = recipe_content_hash(recipe_row['output_item'], recipe_row['output_quantity'], recipe_row['component_blob'])
+        if content_hash in seen_hashes:
+            duplicate_row_list.append({'unique_id': recipe_row['unique_id']})
+            continue
+        seen_hashes.add(content_hash)
+        hash_row_list.append({'unique_id': recipe_row['unique_id'], 'content_hash': content_hash})
+
+    with db.transaction():
+        if duplicate_row_list:
+            db.bulk_query('DELETE FROM recipe_ingredients WHERE unique_id = :unique_id;', duplicate_row_list)
+            db.bulk_query('DELETE FROM recipes WHERE unique_id = :unique_id;', duplicate_row_list)
+        db.bulk_query('UPDATE recipes SET content_hash = :content_hash WHERE unique_id = :unique_id;', hash_row_list)
+        db.query('CREATE UNIQUE INDEX IF NOT EXISTS recipes_content_hash ON recipes (content_hash);')
+
+    if verbose:
+        print('removed {count} duplicate recipes'.format(count=len(duplicate_row_list)))
+
+
+def migrate_expansion_depth():
+    # base recipes from before expansion_depth existed count as unexpanded. altered ones were built by a pass that
+    # expanded everything it could, so they're marked fully expanded and alternate_recipes leaves them be.
+    column_list = [column['name'] for column in db.query('PRAGMA table_info(recipes);').as_dict()]
+    if 'expansion_depth' not in column_list:
+        with db.transaction():
+            db.query('ALTER TABLE recipes ADD COLUMN expansion_depth INTEGER NOT NULL DEFAULT 0;')
+            db.query('UPDATE recipes SET expansion_depth = :depth WHERE is_altered = 1;', depth=fully_expanded_depth)
+
+
+def migrate_recipe_details():
+    # disciplines and crafting time stay NULL on older recipes until the recipe table is rebuilt.
+    column_list = [column['name'] for column in db.query('PRAGMA table_info(recipes);').as_dict()]
+    if 'disciplines' not in column_list:
+        db.query('ALTER TABLE recipes ADD COLUMN disciplines TEXT;')
+    if 'time_to_craft_ms' not in column_list:
+        db.query('ALTER TABLE recipes ADD COLUMN time_to_craft_ms INTEGER;')
+
+
+def migrate_discipline_steps():
+    # altered recipes used to hold the union of their steps' disciplines, which can't be split back into steps, so
+    # they're marked unknown until the alternate recipes are rebuilt. user_version 1 means steps are stored.
+    if db.query('PRAGMA user_version;').all()[0][0] >= 1:
+        return
+    with db.transaction():
+        db.query('UPDATE recipes SET disciplines = NULL WHERE is_altered = 1;')
+    db.query('PRAGMA user_version = 1;')
+
+
+def migrate_best_costs():
+    # databases from before item_best_cost existed get it computed, and the pricing view rebuilt on top of it.
+    if 'item_best_cost' not in db.get_table_names():
+        init_views()
+
+
+def insert_recipes(recipe_row_list):
+    # writes recipes and their recipe_ingredients rows, call inside a transaction.
+    # rows need a component_blob, component_string and content_hash are filled in from it.
+    # a recipe whose content_hash is already in the table is skipped, along with its ingredient rows.
+    insert_string = """INSERT OR IGNORE INTO recipes ( game_id, is_altered, unique_id, output_item, output_quantity, needs_recipe, component_string, component_blob, content_hash,
+    expansion_depth, disciplines, time_to_craft_ms )
+VALUES ( :game_id, :is_altered, :unique_id, :output_item, :output_quantity, :needs_recipe, :component_string, :component_blob, :content_hash,
+    :expansion_depth, :disciplines, :time_to_craft_ms )"""
+    ingredient_insert_string = """INSERT OR IGNORE INTO recipe_ingredients (unique_id, item_id, count)
+SELECT :unique_id, :item_id, :count WHERE EXISTS (SELECT 1 FROM recipes WHERE unique_id = :unique_id AND content_hash = :content_hash);"""
+
+    insert_row_list = []
+    ingredient_row_list = []
+    for recipe_row in recipe_row_list:
+        content_hash = recipe_row.get('content_hash')
+        if content_hash is None:
+            content_hash = recipe_content_hash(recipe_row['output_item'], recipe_row['output_quantity'], recipe_row['component_blob'])
+        insert_row = dict(
+            recipe_row, component_string=blob_to_component_string(recipe_row['component_blob']), content_hash=content_hash,
+            expansion_depth=recipe_row.get('expansion_depth', 0), disciplines=recipe_row.get('disciplines'),
+            time_to_craft_ms=recipe_row.get('time_to_craft_ms')
+        )
+        insert_row_list.append(insert_row)
+        for item_id, count in zip(*unpack_components(recipe_row['component_blob'])):
+            ingredient_row_list.append({'unique_id': recipe_row['unique_id'], 'item_id': item_id, 'count': count, 'content_hash': content_hash})
+
+    db.bulk_query(insert_string, insert_row_list)
+    if ingredient_row_list:
+        db.bulk_query(ingredient_insert_string, ingredient_row_list)
+
+
+def recipes_using_item(item_id):
+    return db.query("""SELECT recipes.* FROM recipe_ingredients
+    JOIN recipes ON recipes.unique_id = recipe_ingredients.unique_id
+    WHERE recipe_ingredients.item_id = :item_id;""", item_id=item_id).as_dict()
 
 
 def init_views():      # karma conversion is how much  karma is worth 1 coin
     if verbose:
         print('initialising views')
 
+    init_best_costs()
+    refresh_best_costs()
+
+    # kept for ad hoc queries, reads the precomputed buy prices out of item_best_cost.
     db.query(query='DROP VIEW IF EXISTS pricing;')
     create_string = """CREATE VIEW pricing AS
-    SELECT item_id, name, tp_cost, vendor_cost, karma_cost,
-        CASE WHEN tp_cost < vendor_cost AND tp_cost < karma_cost / {converter} THEN 'tp'
-            WHEN vendor_cost <= tp_cost AND vendor_cost <= karma_cost / {converter} THEN 'vendor'
-            WHEN karma_cost / {converter} < vendor_cost AND tp_cost >= karma_cost / {converter} THEN 'karma'
-        ELSE 'none' END AS best_method,
-        
-        CASE WHEN tp_cost < vendor_cost AND tp_cost < karma_cost / {converter} THEN tp_cost
-            WHEN vendor_cost <= tp_cost AND vendor_cost <= karma_cost / {converter} THEN vendor_cost
-            WHEN karma_cost / {converter} < vendor_cost AND tp_cost >= karma_cost / {converter} THEN karma_cost
-        ELSE 0 END AS best_cost
-    FROM items""".format(converter=karma_conversion)
+    SELECT items.item_id, name, tp_cost, vendor_cost, karma_cost, buy_method AS best_method, buy_cost AS best_cost
+    FROM items JOIN item_best_cost ON item_best_cost.item_id = items.item_id"""
     db.query(query=create_string)
 
 
+def init_best_costs():
+    db.query(query='DROP TABLE IF EXISTS item_best_cost;')
+    db.query(query="""CREATE TABLE item_best_cost (
+    item_id INTEGER PRIMARY KEY,
+    buy_method TEXT NOT NULL,
+    buy_cost REAL NOT NULL,
+    craft_cost REAL,
+    craft_recipe INTEGER,
+    best_cost REAL NOT NULL
+);""")
+
+
+@metrics.timed_stage
+def refresh_best_costs():
+    # recomputes item_best_cost: the cheapest way to buy each item, the cheapest base recipe for it when every
+    # ingredient is itself bought or crafted as cheaply as possible, and the cheaper of the two.
+    # only rows that changed are written. returns the ids of items whose buy_cost or best_cost changed.
+    if 'item_best_cost' not in db.get_table_names():
+        init_best_costs()
+
+    buy_string = """SELECT item_id,
+        CASE WHEN tp_cost < vendor_cost AND tp_cost < karma_coin THEN 'tp'
+            WHEN vendor_cost <= tp_cost AND vendor_cost <= karma_coin THEN 'vendor'
+            WHEN karma_coin < vendor_cost AND tp_cost >= karma_coin THEN 'karma'
+        ELSE 'none' END AS buy_method,
+
+        CASE WHEN tp_cost < vendor_cost AND tp_cost < karma_coin THEN tp_cost
+            WHEN vendor_cost <= tp_cost AND vendor_cost <= karma_coin THEN vendor_cost
+            WHEN karma_coin < vendor_cost AND tp_cost >= karma_coin THEN karma_coin
+        ELSE 0 END AS buy_cost
+    FROM (SELECT item_id, tp_cost, vendor_cost, karma_cost / {converter} AS karma_coin FROM items)""".format(converter=karma_conversion)
+    buy_dict = {row[0]: (row[1], row[2]) for row in db.query(buy_string).all()}
+    best_cost_dict = {item_id: buy_cost for item_id, (buy_method, buy_cost) in buy_dict.items()}
+
+    recipe_list = []
+    if 'recipes' in db.get_table_names():
+        recipe_list = db.query('SELECT unique_id, output_item, output_quantity, component_blob FROM recipes WHERE is_altered = 0;').all()
+
+    # relax until no recipe makes anything cheaper. costs only ever go down, the round cap stops
+    # conversion loops that come out ahead from going on forever.
+    craft_dict = {}
+    for round_number in range(100):
+        changed = False
+        for unique_id, output_item, output_quantity, component_blob in recipe_list:
+            craft_cost = unit_cost({'component_blob': component_blob, 'output_quantity': output_quantity}, best_cost_dict)
+            if craft_cost < craft_dict.get(output_item, (float('inf'), None))[0]:
+                craft_dict[output_item] = (craft_cost, unique_id)
+            if craft_cost < best_cost_dict.get(output_item, float('inf')):
+                best_cost_dict[output_item] = craft_cost
+                changed = True
+        if not changed:
+            break
+
+    previous_dict = {row[0]: tuple(row) for row in db.query('SELECT item_id, buy_method, buy_cost, craft_cost, craft_recipe, best_cost FROM item_best_cost;').all()}
+    cost_row_list = []
+    changed_item_ids = set()
+    for item_id, (buy_method, buy_cost) in buy_dict.items():
+        craft_cost, craft_recipe = craft_dict.get(item_id, (None, None))
+        if craft_cost == float('inf'):
+            craft_cost, craft_recipe = None, None
+        row = (item_id, buy_method, buy_cost, craft_cost, craft_recipe, best_cost_dict[item_id])
+        previous_row = previous_dict.get(item_id)
+        if row == previous_row:
+            continue
+        if previous_row is None or previous_row[2] != row[2] or previous_row[5] != row[5]:
+            changed_item_ids.add(item_id)
+        cost_row_list.append(dict(zip(('item_id', 'buy_method', 'buy_cost', 'craft_cost', 'craft_recipe', 'best_cost'), row)))
+
+    if cost_row_list:
+        with db.transaction():
+            db.bulk_query("""INSERT OR REPLACE INTO item_best_cost (item_id, buy_method, buy_cost, craft_cost, craft_recipe, best_cost)
+    VALUES (:item_id, :buy_method, :buy_cost, :craft_cost, :craft_recipe, :best_cost);""", cost_row_list)
+
+    return changed_item_ids
+
+
+@metrics.timed_stage
 def populate_items(item_id_list=None):
+    # skips ids already checkpointed by an earlier, interrupted run. returns the ids the api didn't return.
     if item_id_list is None:
         item_id_list = api_query(payload='', endpoint='item_details')
 
-    with_value_template = '{id}, "{name}", {value}, {bound}), ('
-    without_value_template = '{id}, "{name}", {bound}), ('
-
-    item_list_chunks = [item_id_list[x:x + 200] for x in range(0, len(item_id_list), 200)]      # 200 is max paging size per wiki on the api v2. this code stolen from stack exchange.
-    for batch_number, chunk in enumerate(item_list_chunks):
-        with_values_flag = False
-        without_values_flag = False
-        insert_string_with_value = "INSERT INTO items(item_id, name, vendor_value, bound) VALUES ("
-        insert_string_without_value = "INSERT INTO items(item_id, name, bound) VALUES ("
-        item_details_list = api_query(payload=chunk, endpoint='multi_item', default=[])
-        for item_number, item_dict in enumerate(item_details_list):
-            if verbose:
-                print('\rpopulating items table - chunk {current_chunk} of {total_chunks} - item {current_item} of {total_items}'.format(
-                    current_chunk=batch_number +1, total_chunks=len(item_list_chunks),
-                    current_item=item_number +1, total_items=len(item_details_list)
-                ), end='')  # zero index
+    # an upsert rather than INSERT OR REPLACE, which would delete the row and lose the vendor, karma and tp prices on it.
+    insert_string = """INSERT INTO items (item_id, name, vendor_value, bound) VALUES (:item_id, :name, :vendor_value, :bound)
+    ON CONFLICT (item_id) DO UPDATE SET name = excluded.name, vendor_value = excluded.vendor_value, bound = excluded.bound;"""
+
+    done_item_ids = checkpoint_ids(stage='items')
+    item_id_list = [item_id for item_id in item_id_list if item_id not in done_item_ids]
+    missed_items = set(item_id_list)
 
-            item_id = item_dict.get('id')
-            item_name = item_dict.get('name').replace('"', "'")     # very irritating
+    item_list_chunks = gw2api.chunk_list(item_id_list)
+    chunk_results = gw2api.get_json_chunks(chunks=item_list_chunks, endpoint='multi_item', default=[])
+    for batch_number, (chunk, item_details_list) in enumerate(chunk_results):
+        if verbose:
+            print('\rpopulating items table - chunk {current_chunk} of {total_chunks}'.format(
+                current_chunk=batch_number +1, total_chunks=len(item_list_chunks)
+            ), end='')  # zero index
+
+        item_row_list = []
+        for item_dict in item_details_list:
             flags = item_dict.get('flags', [])
 
             if 'SoulbindOnAcquire' in flags or 'AccountBound' in flags:
@@ -207,30 +569,25 @@ def populate_items(item_id_list=None):
                 bound = 0
 
             if 'NoSell' in flags:
-                vendor_value = None
-            else:
-                vendor_value = item_dict.get('vendor_value', None)
-
-            if vendor_value:
-                with_values_flag = True
-                insert_string_with_value = '{}{}'.format(insert_string_with_value, with_value_template.format(id=item_id, name=item_name, value=vendor_value, bound=bound))
+                vendor_value = 0
             else:
-                without_values_flag = True
-                insert_string_without_value = '{}{}'.format(insert_string_without_value, without_value_template.format(id=item_id, name=item_name, bound=bound))
+                vendor_value = item_dict.get('vendor_value', 0)
 
-        if with_values_flag:
-            insert_string_with_value = insert_string_with_value[:-3]
-            db.query(query=insert_string_with_value.format(id=item_id, bound=bound))
+            item_row_list.append({'item_id': item_dict.get('id'), 'name': item_dict.get('name'), 'vendor_value': vendor_value, 'bound': bound})
 
-        if without_values_flag:
-            insert_string_without_value = insert_string_without_value[:-3]
-            db.query(query=insert_string_without_value.format(id=item_id, value=vendor_value, bound=bound))
+        if item_row_list:
+            item_ids = [item_row['item_id'] for item_row in item_row_list]
+            with db.transaction():
+                db.bulk_query(insert_string, item_row_list)
+                record_checkpoint(stage='items', id_list=item_ids)
+            missed_items.difference_update(item_ids)
     if verbose:
         print(' - done.')
 
-    vacuum()
+    return [item_id for item_id in item_id_list if item_id in missed_items]
 
 
+@metrics.timed_stage
 def vendor_pricing(vendor_dict=None):
     # dict must be of the form item_id: vendor price.
     if verbose:
@@ -243,68 +600,218 @@ def vendor_pricing(vendor_dict=None):
             except FileNotFoundError:
                 vendor_dict = {}
 
-    update_cost_string = '''
-    UPDATE items
-    SET vendor_cost = {cost}
-    WHERE item_id = {id};'''
-    update_karma_string = '''
-    UPDATE items
-    SET karma_cost = {karma}
-    WHERE item_id = {id};'''
+    update_string = """UPDATE items
+    SET vendor_cost = COALESCE(:vendor_cost, vendor_cost), karma_cost = COALESCE(:karma_cost, karma_cost)
+    WHERE item_id = :item_id;"""
 
+    cost_row_list = []
     for item_id, costs in vendor_dict.items():
-        vendor_cost = costs.get('vendor', None)
-        karma_cost = costs.get('karma', None)
-        if vendor_cost:
-            db.query(query=update_cost_string.format(id=item_id, cost=vendor_cost))
-        if karma_cost:
-            db.query(query=update_karma_string.format(id=item_id, karma=karma_cost))
-
-    vacuum()
-
+        vendor_cost = costs.get('vendor', None) or None
+        karma_cost = costs.get('karma', None) or None
+        if vendor_cost or karma_cost:
+            cost_row_list.append({'item_id': item_id, 'vendor_cost': vendor_cost, 'karma_cost': karma_cost})
+
+    if cost_row_list:
+        with db.transaction():
+            db.bulk_query(update_string, cost_row_list)
+    refresh_best_costs()
+
+
+def item_id_filter(tradable_only=False, recipe_items_only=False):
+    where_string = 'item_id > 0'
+    if tradable_only:
+        where_string += ' AND COALESCE(bound, 0) = 0'
+    if recipe_items_only:
+        where_string += """ AND (EXISTS (SELECT 1 FROM recipe_ingredients WHERE recipe_ingredients.item_id = items.item_id)
+        OR EXISTS (SELECT 1 FROM recipes WHERE recipes.output_item = items.item_id))"""
+    return where_string
+
+
+def iter_item_id_chunks(size=200, tradable_only=False, recipe_items_only=False):
+    # pages through the items table in item_id order, picking up after the last id of the previous page,
+    # so only one page of ids is held at a time.
+    query_string = 'SELECT item_id FROM items WHERE {where} AND item_id > :last_item_id ORDER BY item_id LIMIT :size;'.format(
+        where=item_id_filter(tradable_only=tradable_only, recipe_items_only=recipe_items_only)
+    )
+    last_item_id = 0
+    while True:
+        item_id_chunk = [row[0] for row in db.query(query_string, last_item_id=last_item_id, size=size).all()]
+        if not item_id_chunk:
+            return
+        yield item_id_chunk
+        last_item_id = item_id_chunk[-1]
+
+
+@metrics.timed_stage
+def trading_post_pricing(item_list=None, tradable_only=None, recipe_items_only=None):
+    # prices item_list, or every item in the table that passes the filters (config defaults if not given).
+    # returns the set of item ids whose tp_cost or tp_value changed, only those rows are written.
+    if tradable_only is None:
+        tradable_only = tp_tradable_only
+    if recipe_items_only is None:
+        recipe_items_only = tp_recipe_items_only
 
-def trading_post_pricing(item_list=None):
     if item_list is None:
-        #todo get rid of this kludge holy shit
-        item_list = eval(db.query('SELECT item_id FROM items;').export('csv').replace('\r\n', ', ')[9:])
+        item_list_chunks = iter_item_id_chunks(tradable_only=tradable_only, recipe_items_only=recipe_items_only)
+        total_chunks = '?'
+        if verbose:
+            item_count = db.query('SELECT COUNT(*) FROM items WHERE {where};'.format(
+                where=item_id_filter(tradable_only=tradable_only, recipe_items_only=recipe_items_only)
+            )).all()[0][0]
+            total_chunks = -(-item_count // 200)
+    else:
+        item_list_chunks = gw2api.chunk_list(item_list)
+        total_chunks = len(item_list_chunks)
 
-    update_string ="UPDATE items SET tp_{type} = {cost} WHERE item_id = {id};"
+    # only ids that came from the items table are priced, the insert half of the upsert just keeps stray ids harmless.
+    upsert_string = """INSERT INTO items (item_id, tp_cost, tp_value)
+    VALUES (:item_id, COALESCE(:tp_cost, 1234567890), COALESCE(:tp_value, 0))
+    ON CONFLICT (item_id) DO UPDATE SET tp_cost = COALESCE(:tp_cost, tp_cost), tp_value = COALESCE(:tp_value, tp_value);"""
 
-    item_list_chunks = [item_list[x:x + 200] for x in range(0, len(item_list), 200)]      # 200 is max paging size per wiki on the api v2. this code stolen from stack exchange.
-    for batch_number, chunk in enumerate(item_list_chunks, start=1):
+    changed_item_ids = set()
+    chunk_results = gw2api.get_json_chunks(chunks=item_list_chunks, endpoint='multi_pricing', default=[])
+    for batch_number, (chunk, pricing_dict_list) in enumerate(chunk_results, start=1):
         if verbose:
-            print('\rupdating trading post pricing - chunk {current} of {total}'.format(current=batch_number, total=len(item_list_chunks)), end='')
+            print('\rupdating trading post pricing - chunk {current} of {total}'.format(current=batch_number, total=total_chunks), end='')
 
-        pricing_dict_list = api_query(payload=chunk, endpoint='multi_pricing', default=[])
+        previous_price_dict = {}
+        if pricing_dict_list:
+            previous_price_query = 'SELECT item_id, tp_cost, tp_value FROM items WHERE item_id IN ({ids});'.format(
+                ids=gw2api.ids_to_string([pricing_dict.get('id') for pricing_dict in pricing_dict_list])
+            )
+            for item_id, tp_cost, tp_value in db.query(previous_price_query).all():
+                previous_price_dict[item_id] = (tp_cost, tp_value)
 
+        price_row_list = []
         for pricing_dict in pricing_dict_list:
             # you BUY instantly from sells and you SELL instantly to buys
             item_id = pricing_dict.get('id')
             sell_dict = pricing_dict.get('buys', None)
             buy_dict = pricing_dict.get('sells', None)
+            previous_cost, previous_value = previous_price_dict.get(item_id, (None, None))
+            tp_value = sell_dict['unit_price'] if sell_dict else None
+            tp_cost = buy_dict['unit_price'] if buy_dict else None
+
+            if (tp_cost is None or tp_cost == previous_cost) and (tp_value is None or tp_value == previous_value):
+                continue
+            price_row_list.append({'item_id': item_id, 'tp_value': tp_value, 'tp_cost': tp_cost})
+            changed_item_ids.add(item_id)
 
-            if sell_dict:
-                cost_to_sell = sell_dict['unit_price']
-                db.query(query=update_string.format(type='value', cost=cost_to_sell, id=item_id))
-            if buy_dict:
-                cost_to_buy = buy_dict['unit_price']
-                db.query(query=update_string.format(type='cost', cost=cost_to_buy, id=item_id))
+        if price_row_list:
+            with db.transaction():
+                db.bulk_query(upsert_string, price_row_list)
     if verbose:
-        print(' - done.')
+        print(' - done, {changed} prices changed.'.format(changed=len(changed_item_ids)))
+
+    # items that are now cheaper or dearer to craft count as changed too.
+    changed_item_ids.update(refresh_best_costs())
+
+    return changed_item_ids
+
+
+def init_order_books():
+    # one row per item: the price levels you can sell into (buys, highest first) and buy from (sells, lowest first),
+    # each as a packed uint32 array of prices and a matching one of quantities.
+    db.query(query="""CREATE TABLE IF NOT EXISTS order_books (
+    item_id INTEGER PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    buy_prices BLOB NOT NULL,
+    buy_quantities BLOB NOT NULL,
+    sell_prices BLOB NOT NULL,
+    sell_quantities BLOB NOT NULL
+);""")
+
 
-    vacuum()
+def pack_ladder(listing_list, descending):
+    # merges listings at the same price and sorts them best first.
+    quantity_by_price = Counter()
+    for listing in listing_list:
+        quantity_by_price[listing['unit_price']] += listing['quantity']
+    price_list = sorted(quantity_by_price, reverse=descending)
+    return uint32_bytes(price_list), uint32_bytes([quantity_by_price[price] for price in price_list])
 
 
-def populate_recipe_table(recipe_list=None):
+@metrics.timed_stage
+def order_book_pricing(item_list=None):
+    # stores the full order book of item_list, or of every tradable item a recipe uses or makes.
+    # returns the number of books stored.
+    import time
+
+    init_order_books()
+    if item_list is None:
+        item_list_chunks = iter_item_id_chunks(tradable_only=True, recipe_items_only=True)
+    else:
+        item_list_chunks = gw2api.chunk_list(item_list)
+
+    upsert_string = """INSERT OR REPLACE INTO order_books (item_id, fetched_at, buy_prices, buy_quantities, sell_prices, sell_quantities)
+    VALUES (:item_id, :fetched_at, :buy_prices, :buy_quantities, :sell_prices, :sell_quantities);"""
+
+    book_count = 0
+    chunk_results = gw2api.get_json_chunks(chunks=item_list_chunks, endpoint='multi_listings', default=[])
+    for batch_number, (chunk, listings_dict_list) in enumerate(chunk_results, start=1):
+        if verbose:
+            print('\rupdating order books - chunk {current}'.format(current=batch_number), end='')
+
+        fetched_at = time.time()
+        book_row_list = []
+        for listings_dict in listings_dict_list:
+            buy_prices, buy_quantities = pack_ladder(listings_dict.get('buys', []), descending=True)
+            sell_prices, sell_quantities = pack_ladder(listings_dict.get('sells', []), descending=False)
+            book_row_list.append({
+                'item_id': listings_dict['id'], 'fetched_at': fetched_at, 'buy_prices': buy_prices, 'buy_quantities': buy_quantities,
+                'sell_prices': sell_prices, 'sell_quantities': sell_quantities
+            })
+
+        if book_row_list:
+            with db.transaction():
+                db.bulk_query(upsert_string, book_row_list)
+            book_count += len(book_row_list)
+    if verbose:
+        print(' - done, {count} order books stored.'.format(count=book_count))
+
+    return book_count
+
+
+def load_order_books(item_id_list):
+    # item_id: (buy prices, buy quantities, sell prices, sell quantities) as arrays, for the items that have a book.
+    book_dict = {}
+    if 'order_books' not in db.get_table_names():
+        return book_dict
+
+    for item_id_chunk in gw2api.chunk_list(sorted(set(item_id_list)), size=500):
+        book_row_list = db.query('SELECT item_id, buy_prices, buy_quantities, sell_prices, sell_quantities FROM order_books WHERE item_id IN ({ids});'.format(
+            ids=gw2api.ids_to_string(item_id_chunk)
+        )).all()
+        for item_id, buy_prices, buy_quantities, sell_prices, sell_quantities in book_row_list:
+            book_dict[item_id] = tuple(uint32_view(blob) for blob in (buy_prices, buy_quantities, sell_prices, sell_quantities))
+
+    return book_dict
+
+
+@metrics.timed_stage
+def populate_recipe_table(recipe_list=None, stage='recipes'):
+    # skips ids already checkpointed by an earlier, interrupted run of the stage. returns the ids that still need
+    # fetching. ad hoc top ups outside a build pass stage=None, so they neither read nor write checkpoints.
     if recipe_list is None:
         recipe_list = api_query(payload='', endpoint='recipe_details')
 
-    missed_recipes = recipe_list.copy()
-    skip_recipes = []
-
-    recipe_list_chunks = [recipe_list[x:x + 200] for x in range(0, len(recipe_list), 200)]      # 200 is max paging size per wiki on the api v2. this code stolen from stack exchange.
-    for batch_number, chunk in enumerate(recipe_list_chunks, start=1):
-        recipe_dict_list = api_query(payload=chunk, endpoint='multi_recipe')
+    if stage is not None:
+        done_recipe_ids = checkpoint_ids(stage=stage)
+        recipe_list = [recipe_id for recipe_id in recipe_list if recipe_id not in done_recipe_ids]
+    init_recipe_variants()
+    missed_recipes = set(recipe_list)
+
+    # discipline variants of a recipe are identical apart from their id and discipline, only the first one seen is
+    # kept, with the disciplines of the others added to it.
+    seen_hashes = set(row[0] for row in db.query('SELECT content_hash FROM recipes;').all())
+
+    recipe_list_chunks = gw2api.chunk_list(recipe_list)
+    chunk_results = gw2api.get_json_chunks(chunks=recipe_list_chunks, endpoint='multi_recipe', default=[])
+    for batch_number, (chunk, recipe_dict_list) in enumerate(chunk_results, start=1):
+        recipe_row_list = []
+        done_id_list = []
+        variant_disciplines_dict = {}     # content_hash: disciplines of variants of an already kept recipe
+        variant_row_list = []
         for recipe_number, recipe_dict in enumerate(recipe_dict_list, start=1):
             if verbose:
                 print('\rpopulating recipe table - chunk {current_chunk} of {total_chunks} - recipe {current_recipe} of {total_recipes}'.format(
@@ -312,21 +819,20 @@ def populate_recipe_table(recipe_list=None):
                     current_recipe=recipe_number, total_recipes=len(recipe_dict_list)
                 ), end='')
 
-            insert_string = """INSERT INTO recipes ( game_id, is_altered, unique_id, output_item, output_quantity, needs_recipe, component_string )
-VALUES ( {id}, 0, {unique_id}, {output_id}, {output_quantity}, {needs_recipe}, '{component_string}' )"""
-
             recipe_id = recipe_dict.get('id')
-            if recipe_id in skip_recipes:
-                missed_recipes.remove(recipe_id)
-                skip_recipes.remove(recipe_id)
-                continue
-
+            done_id_list.append(recipe_id)
             output_item_id = recipe_dict.get('output_item_id')
-            recipes_to_skip = api_query(payload=output_item_id, endpoint='recipes_output')
-            if recipes_to_skip:
-                skip_recipes.extend(recipes_to_skip)
-
             output_quantity = recipe_dict.get('output_item_count')
+            component_blob = pack_components(recipe_dict.get('ingredients', []))
+
+            content_hash = recipe_content_hash(output_item_id, output_quantity, component_blob)
+            disciplines = ','.join(recipe_dict.get('disciplines', []))
+            if content_hash in seen_hashes:
+                variant_row_list.append({'game_id': recipe_id, 'content_hash': content_hash})
+                variant_disciplines_dict[content_hash] = merge_variant_disciplines(variant_disciplines_dict.get(content_hash, ''), disciplines)
+                continue
+            seen_hashes.add(content_hash)
+
             flags = recipe_dict.get('flags')
             if 'LearnedFromItem' in flags:
                 needs_recipe = 1
@@ -335,106 +841,266 @@ VALUES ( {id}, 0, {unique_id}, {output_id}, {output_quantity}, {needs_recipe}, '
 
             unique_id = generate_unique_id(recipe_id=recipe_id, size=7)
 
-            component_string = dict_list_to_string(recipe_dict_list=recipe_dict.get('ingredients', []))
-
-            query_string = insert_string.format(
-                id=recipe_id, output_id=output_item_id, output_quantity=output_quantity, unique_id=unique_id,
-                needs_recipe=needs_recipe, component_string=component_string
-            )
-
-            db.query(query=query_string)
-            missed_recipes.remove(recipe_id)
-            if recipe_id in skip_recipes:
-                skip_recipes.remove(recipe_id)
+            recipe_row_list.append({
+                'game_id': recipe_id, 'is_altered': 0, 'output_item': output_item_id, 'output_quantity': output_quantity, 'unique_id': unique_id,
+                'needs_recipe': needs_recipe, 'component_blob': component_blob, 'content_hash': content_hash,
+                'disciplines': disciplines, 'time_to_craft_ms': recipe_dict.get('time_to_craft_ms')
+            })
+
+        with db.transaction():
+            if recipe_row_list:
+                insert_recipes(recipe_row_list)
+            if variant_disciplines_dict:
+                discipline_row_list = db.query('SELECT content_hash, disciplines FROM recipes WHERE content_hash IN ({hashes});'.format(
+                    hashes=gw2api.ids_to_string(list(variant_disciplines_dict))
+                )).all()
+                db.bulk_query('UPDATE recipes SET disciplines = :disciplines WHERE content_hash = :content_hash;', [
+                    {'content_hash': content_hash, 'disciplines': merge_variant_disciplines(disciplines, variant_disciplines_dict[content_hash])}
+                    for content_hash, disciplines in discipline_row_list
+                ])
+            if variant_row_list:
+                db.bulk_query('INSERT OR IGNORE INTO recipe_variants (game_id, content_hash) VALUES (:game_id, :content_hash);', variant_row_list)
+            if stage is not None:
+                record_checkpoint(stage=stage, id_list=done_id_list)
+        missed_recipes.difference_update(done_id_list)
     if verbose:
         print(' - done.')
 
-    vacuum()
-    return missed_recipes
+    return [recipe_id for recipe_id in recipe_list if recipe_id in missed_recipes]
+
+
+def load_recipe_graph():
+    # recipes are held in a list and referred to by their index in it.
+    # producers maps an item to the recipes that output it, consumers maps an item to the recipes that use it.
+    from collections import defaultdict
+
+    recipe_list = db.query("""SELECT game_id, is_altered, unique_id, needs_recipe, output_item, output_quantity, component_blob, content_hash, expansion_depth,
+        disciplines, time_to_craft_ms
+    FROM recipes ORDER BY is_altered ASC, game_id ASC;""").as_dict()
+    producers = defaultdict(list)
+    consumers = defaultdict(list)
+    for recipe_index, recipe_dict in enumerate(recipe_list):
+        add_to_recipe_graph(recipe_index=recipe_index, recipe_dict=recipe_dict, producers=producers, consumers=consumers)
+
+    return recipe_list, producers, consumers
+
+
+def add_to_recipe_graph(recipe_index, recipe_dict, producers, consumers):
+    producers[recipe_dict['output_item']].append(recipe_index)
+    for item_id in unpack_components(recipe_dict['component_blob'])[0]:
+        consumers[item_id].append(recipe_index)
+
+
+def discipline_steps(disciplines):
+    # disciplines holds one ','-joined set per crafting step, the steps joined by ';'. any discipline in a step's set
+    # can craft that step, so a base recipe is a single step and an altered recipe has one per distinct step.
+    if disciplines is None:
+        return None
+    return [frozenset(step.split(',')) - {''} for step in disciplines.split(';')]
+
+
+def steps_to_disciplines(step_list):
+    return ';'.join(sorted(','.join(sorted(step)) for step in set(step_list)))
+
+
+def merge_variant_disciplines(first_disciplines, second_disciplines):
+    # discipline variants of one base recipe: a crafter with any discipline of either can make it.
+    if first_disciplines is None or second_disciplines is None:
+        return None
+    return steps_to_disciplines([frozenset().union(*discipline_steps(first_disciplines), *discipline_steps(second_disciplines))])
+
+
+def combine_disciplines(first_disciplines, second_disciplines):
+    # an altered recipe needs every step of both recipes crafted, NULL if either is unknown. a step whose set contains
+    # another step's set adds nothing, whoever can craft the smaller one can craft it too.
+    if first_disciplines is None or second_disciplines is None:
+        return None
+    step_set = set(discipline_steps(first_disciplines) + discipline_steps(second_disciplines))
+    return steps_to_disciplines([step for step in step_set if not any(other_step < step for other_step in step_set)])
+
+
+def can_craft(disciplines, discipline):
+    # True if a crafter with just this discipline can craft every step.
+    step_list = discipline_steps(disciplines)
+    return step_list is not None and all(discipline in step for step in step_list)
+
+
+def combine_craft_times(first_time, first_multiplier, second_time, second_multiplier):
+    if first_time is None or second_time is None:
+        return None
+    return first_time * first_multiplier + second_time * second_multiplier
 
 
-def alternate_recipes(debug=False):
+def combine_recipes(product_recipe_dict, component_recipe_dict):
+    # replaces the component recipe's output in the product recipe with the component recipe's ingredients,
+    # scaling both so that whole numbers of each recipe are crafted.
     from math import gcd
-    added_recipes = False
+
+    component_recipe_output_item = component_recipe_dict['output_item']
+    component_recipe_output_quantity = component_recipe_dict['output_quantity']
+    components_needed = component_count(product_recipe_dict['component_blob'], component_recipe_output_item)
+
+    discrepancy_gcd = gcd(component_recipe_output_quantity, components_needed)
+    component_multiplier = components_needed // discrepancy_gcd
+    product_multiplier = component_recipe_output_quantity // discrepancy_gcd
+
+    combined_output_quantity = product_recipe_dict['output_quantity'] * product_multiplier
+    combined_recipe_blob = merge_components(
+        product_recipe_dict['component_blob'], product_multiplier, component_recipe_dict['component_blob'], component_multiplier,
+        item_to_remove=component_recipe_output_item
+    )
+    if combined_recipe_blob is None or combined_output_quantity > max_component_count:
+        return None     # scaled past what a packed recipe can hold
+
+    combined_recipe_dict = {
+        'game_id': product_recipe_dict['game_id'],
+        'is_altered': 1,
+        'output_item': product_recipe_dict['output_item'],
+        'needs_recipe': product_recipe_dict['needs_recipe'],
+        'output_quantity': combined_output_quantity,
+        'unique_id': generate_unique_id(product_recipe_dict['unique_id'], component_recipe_dict['unique_id'], size=7),
+        'component_blob': combined_recipe_blob,
+        'expansion_depth': product_recipe_dict['expansion_depth'] + component_recipe_dict['expansion_depth'] + 1,
+        'disciplines': combine_disciplines(product_recipe_dict['disciplines'], component_recipe_dict['disciplines']),
+        'time_to_craft_ms': combine_craft_times(
+            product_recipe_dict['time_to_craft_ms'], product_multiplier, component_recipe_dict['time_to_craft_ms'], component_multiplier
+        ),
+        'content_hash': recipe_content_hash(product_recipe_dict['output_item'], combined_output_quantity, combined_recipe_blob)
+    }
+    return combined_recipe_dict
+
+
+def dominates(recipe_dict, other_recipe_dict):
+    # True if recipe_dict uses no more of any ingredient per item made than other_recipe_dict does,
+    # which makes it at least as cheap whatever the prices are.
+    item_ids, counts = unpack_components(recipe_dict['component_blob'])
+    other_item_ids, other_counts = unpack_components(other_recipe_dict['component_blob'])
+    quantity = recipe_dict['output_quantity']
+    other_quantity = other_recipe_dict['output_quantity']
+
+    other_position = 0
+    for item_id, count in zip(item_ids, counts):
+        while other_position < len(other_item_ids) and other_item_ids[other_position] < item_id:
+            other_position += 1
+        if other_position == len(other_item_ids) or other_item_ids[other_position] != item_id:
+            return False
+        if count * other_quantity > other_counts[other_position] * quantity:
+            return False
+
+    return True
+
+
+def unit_cost(recipe_dict, cost_dict):
+    # cost of the ingredients per item made at the prices in cost_dict, infinite if any ingredient has no price.
+    total_cost = 0
+    for item_id, count in zip(*unpack_components(recipe_dict['component_blob'])):
+        total_cost += count * cost_dict.get(item_id, float('inf'))
+    return total_cost / recipe_dict['output_quantity']
+
+
+@metrics.timed_stage
+def alternate_recipes(debug=False, max_depth=None, pruning=None):
+    # substitutes every recipe into every recipe that uses its output, repeating on the results until nothing new
+    # comes out, then writes the new recipes in one go. returns the number of recipes added.
+    # max_depth caps how many substitutions a recipe is built from, 0 for no cap. pruning drops a new recipe that
+    # another recipe for the same output beats: 'dominance' when it uses no more of any ingredient per item made,
+    # 'live' when it is cheaper at current prices, 'none' keeps everything.
+    from collections import deque
+
+    if max_depth is None:
+        max_depth = alt_recipe_depth
+    if pruning is None:
+        pruning = alt_recipe_pruning
+    assert pruning in ('none', 'dominance', 'live')
+
     if verbose:
         print("\radding alternate recipes", end='')
 
-    component_recipe_result_dict_list = db.query("SELECT * FROM recipes ORDER BY is_altered ASC, game_id ASC;").as_dict()
+    recipe_list, producers, consumers = load_recipe_graph()
 
-    unique_id_list = []
-    component_string_list = []
-    for entry in component_recipe_result_dict_list:
-        unique_id_list.append(entry['unique_id'])
-        component_string_list.append(entry['component_string'])
+    cost_dict = {}
+    cheapest_unit_cost = {}
+    if pruning == 'live':
+        cost_dict = {row[0]: row[1] for row in db.query('SELECT item_id, buy_cost FROM item_best_cost;').all()}
+        for recipe_dict in recipe_list:
+            output_item = recipe_dict['output_item']
+            cheapest_unit_cost[output_item] = min(cheapest_unit_cost.get(output_item, float('inf')), unit_cost(recipe_dict, cost_dict))
+    unique_id_set = set(recipe_dict['unique_id'] for recipe_dict in recipe_list)
+    content_hash_set = set(recipe_dict['content_hash'] for recipe_dict in recipe_list)
+
+    # (product recipe index, component recipe index) pairs still to combine.
+    worklist = deque()
+    for component_index, component_recipe_dict in enumerate(recipe_list):
+        for product_index in consumers[component_recipe_dict['output_item']]:
+            worklist.append((product_index, component_index))
+
+    new_recipe_list = []
+    pruned_count = 0
+    overflow_count = 0
+    while worklist:
+        product_index, component_index = worklist.popleft()
+        product_recipe_dict = recipe_list[product_index]
+        component_recipe_dict = recipe_list[component_index]
+
+        combined_unique_id = generate_unique_id(product_recipe_dict['unique_id'], component_recipe_dict['unique_id'], size=7)
+        if combined_unique_id in unique_id_set:
+            continue
+        if max_depth and product_recipe_dict['expansion_depth'] + component_recipe_dict['expansion_depth'] + 1 > max_depth:
+            continue
+        if fully_expanded_depth in (product_recipe_dict['expansion_depth'], component_recipe_dict['expansion_depth']):
+            continue
 
-    for component_recipe_number, component_recipe_dict in enumerate(component_recipe_result_dict_list, start=1):
-        if verbose:
-            print('\radding alternate recipes - component recipe:\t{component} of {max_components}'.format(
-                component=component_recipe_number, max_components=len(component_recipe_result_dict_list)
-            ), end='')
-        component_recipe_unique_id = component_recipe_dict.get('unique_id')
-        component_recipe_output_item = component_recipe_dict.get('output_item')
-        component_recipe_output_quantity = component_recipe_dict.get('output_quantity')
-        component_recipe_component_string = component_recipe_dict.get('component_string')
-        component_output_search_string = component_to_string(item_id=component_recipe_output_item, count=0)[:-2]
-        component_recipe_dict_list = string_to_component_dict_list(component_recipe_component_string)
-        
-        product_recipe_result_dict_list = db.query("SELECT * FROM recipes WHERE component_string LIKE '%{search}%'".format(search=component_output_search_string)).as_dict()
-        for product_recipe_number, product_recipe_dict in enumerate(product_recipe_result_dict_list, start=1):
-            if verbose:
-                print('\radding alternate recipes - component recipe:\t{component} of {max_components} - product recipe:\t{product} of {max_products}'.format(
-                        component=component_recipe_number, max_components=len(component_recipe_result_dict_list),
-                        product=product_recipe_number, max_products=len(product_recipe_result_dict_list),
-                ), end='')
+        combined_recipe_dict = combine_recipes(product_recipe_dict=product_recipe_dict, component_recipe_dict=component_recipe_dict)
+        unique_id_set.add(combined_unique_id)
+        if combined_recipe_dict is None:
+            overflow_count += 1
+            continue
 
-            product_recipe_unique_id = product_recipe_dict.get('unique_id')
-            combined_unique_id = generate_unique_id(product_recipe_unique_id, component_recipe_unique_id, size=7)
-            if combined_unique_id in unique_id_list:
-                continue
-            else:
-                product_recipe_game_id = product_recipe_dict.get('game_id')
-                product_recipe_needs_recipe = product_recipe_dict.get('needs_recipe')
-                product_recipe_output_item = product_recipe_dict.get('output_item')
-                product_recipe_output_quantity = product_recipe_dict.get('output_quantity')
-                product_recipe_string = product_recipe_dict.get('component_string', '')
-                product_recipe_dict_list = string_to_component_dict_list(product_recipe_string)
-            
-                insert_string = """INSERT INTO recipes ( game_id, is_altered, needs_recipe, output_item, output_quantity, unique_id, component_string )
-VALUES ( {game_id}, {is_altered}, {needs_recipe}, {output_item}, {output_quantity}, {unique_id}, '{component_string}' )"""
-
-                for product_recipe_dict in product_recipe_dict_list:
-                    if product_recipe_dict['item_id'] == component_recipe_output_item:
-                        components_needed = product_recipe_dict['count']
-                        break
-
-                discrepancy_gcd = gcd(component_recipe_output_quantity, components_needed)
-                component_multiplier = components_needed // discrepancy_gcd
-                product_multiplier = component_recipe_output_quantity // discrepancy_gcd
-
-                combined_recipe_string = combine_dict_list_to_string([product_recipe_dict_list]*product_multiplier + [component_recipe_dict_list]*component_multiplier, item_to_remove=component_recipe_output_item)
-                combined_recipe_dict = {
-                    'game_id': product_recipe_game_id,
-                    'is_altered': 1,
-                    'output_item': product_recipe_output_item,
-                    'needs_recipe': product_recipe_needs_recipe,
-                    'output_quantity': product_recipe_output_quantity * product_multiplier,
-                    'unique_id': combined_unique_id,
-                    'component_string': combined_recipe_string
-                }
+        if combined_recipe_dict['content_hash'] in content_hash_set:
+            continue
+        # a recipe that uses its own output only turns up through convertible materials, and expanding it never ends.
+        if component_count(combined_recipe_dict['component_blob'], combined_recipe_dict['output_item']):
+            continue
 
-                if combined_recipe_string in component_string_list:
-                    continue
+        content_hash_set.add(combined_recipe_dict['content_hash'])
+        output_item = combined_recipe_dict['output_item']
+        if pruning == 'dominance':
+            if any(dominates(recipe_list[other_index], combined_recipe_dict) for other_index in producers[output_item]):
+                pruned_count += 1
+                continue
+        elif pruning == 'live':
+            combined_unit_cost = unit_cost(combined_recipe_dict, cost_dict)
+            if cheapest_unit_cost.get(output_item, float('inf')) <= combined_unit_cost:
+                pruned_count += 1
+                continue
+            cheapest_unit_cost[output_item] = combined_unit_cost
+
+        new_index = len(recipe_list)
+        recipe_list.append(combined_recipe_dict)
+        new_recipe_list.append(combined_recipe_dict)
+        add_to_recipe_graph(recipe_index=new_index, recipe_dict=combined_recipe_dict, producers=producers, consumers=consumers)
+
+        for next_product_index in consumers[combined_recipe_dict['output_item']]:
+            worklist.append((next_product_index, new_index))
+        for item_id in unpack_components(combined_recipe_dict['component_blob'])[0]:
+            for next_component_index in producers[item_id]:
+                worklist.append((new_index, next_component_index))
+
+        if verbose and len(new_recipe_list) % 1000 == 0:
+            print('\radding alternate recipes - {added} added, {remaining} combinations queued'.format(
+                added=len(new_recipe_list), remaining=len(worklist)
+            ), end='')
 
-                else:
-                    db.query(insert_string.format(**combined_recipe_dict))
-                    unique_id_list.append(combined_unique_id)
-                    component_string_list.append(combined_recipe_string)
-                    added_recipes = True
+    for recipe_row_chunk in gw2api.chunk_list(new_recipe_list, size=10000):
+        with db.transaction():
+            insert_recipes(recipe_row_chunk)
 
     if verbose:
-        print(' - done.')
+        print(' - done, {added} alternate recipes added, {pruned} pruned, {overflowed} too large to store.'.format(
+            added=len(new_recipe_list), pruned=pruned_count, overflowed=overflow_count
+        ))
 
-    return added_recipes
+    return len(new_recipe_list)
 
 
 def best_recipe_by_recipe_id(recipe_id):
@@ -466,8 +1132,7 @@ def best_recipe_by_component(item_id):
         else:
             price_to_beat = item_info['vendor_value']
             default_method = 'vendor'
-        search_string = component_to_string(item_id=item_id, count=0)[:-2]
-        recipe_list = db.query("SELECT * FROM recipes WHERE component_string LIKE '%{search}%'".format(search=search_string)).as_dict()
+        recipe_list = recipes_using_item(item_id=item_id)
         output_dict = best_recipe_by_recipe_list(recipe_dict_list=recipe_list)
 
         if output_dict:
@@ -489,13 +1154,24 @@ def best_recipe_by_component(item_id):
 
 
 def best_recipe_by_recipe_list(recipe_dict_list, output_item_info=None):
+    ingredient_id_set = set()
+    for recipe_dict in recipe_dict_list:
+        ingredient_id_set.update(unpack_components(recipe_dict['component_blob'])[0])
+    ingredient_price_dict = {}
+    for item_id_chunk in gw2api.chunk_list(sorted(ingredient_id_set), size=500):
+        ingredient_price_dict.update((price_dict['item_id'], price_dict) for price_dict in db.query(
+            """SELECT items.item_id, name, buy_method, buy_cost, best_cost, recipes.game_id AS craft_game_id
+            FROM items JOIN item_best_cost ON item_best_cost.item_id = items.item_id LEFT JOIN recipes ON recipes.unique_id = item_best_cost.craft_recipe
+            WHERE items.item_id IN ({ids})""".format(ids=gw2api.ids_to_string(item_id_chunk))
+        ).as_dict())
+
     profit_dict_list = []
     for recipe_dict in recipe_dict_list:
         if output_item_info is None:
             output_item = recipe_dict['output_item']
             output_item_info = db.query("SELECT name, item_id, tp_value, vendor_value FROM items WHERE item_id = {item_id}".format(item_id=output_item)).as_dict()[0]
 
-        ingredient_list = string_to_component_dict_list(recipe_dict['component_string'])
+        ingredient_list = [{'item_id': item_id, 'count': count} for item_id, count in zip(*unpack_components(recipe_dict['component_blob']))]
         output_count = recipe_dict['output_quantity']
         tp_revenue = output_item_info['tp_value'] * output_count
         vendor_revenue = output_item_info['vendor_value'] * output_count
@@ -521,19 +1197,29 @@ def best_recipe_by_recipe_list(recipe_dict_list, output_item_info=None):
         recipe_cost = 0
         recipe_method_dict_list = []
         for ingredient in ingredient_list:
-            item_query = db.query("SELECT * FROM pricing WHERE item_id = {item_id}".format(item_id=ingredient['item_id'])).as_dict()[0]
+            item_query = ingredient_price_dict[ingredient['item_id']]
             input_item_count = ingredient['count']
+            # best_cost is already the cheaper of buying it and crafting it from its own cheapest ingredients.
             best_item_cost = item_query['best_cost']
             best_total_cost = input_item_count * best_item_cost
             recipe_cost += best_total_cost
 
-            alternate_recipe_method_dict = {
-                'type': 'buy',
-                'count': input_item_count,
-                'item': item_query['name'],
-                'method': item_query['best_method'],
-                'cost': format_prices(best_total_cost)
-            }
+            if best_item_cost < item_query['buy_cost'] and item_query['craft_game_id'] is not None:
+                alternate_recipe_method_dict = {
+                    'type': 'craft',
+                    'count': input_item_count,
+                    'item': item_query['name'],
+                    'method': 'recipe {game_id}'.format(game_id=item_query['craft_game_id']),
+                    'cost': format_prices(best_total_cost)
+                }
+            else:
+                alternate_recipe_method_dict = {
+                    'type': 'buy',
+                    'count': input_item_count,
+                    'item': item_query['name'],
+                    'method': item_query['buy_method'],
+                    'cost': format_prices(best_total_cost)
+                }
             recipe_method_dict_list.append(alternate_recipe_method_dict)
         recipe_method_dict_list.append(output_method_dict)
 
@@ -542,8 +1228,7 @@ def best_recipe_by_recipe_list(recipe_dict_list, output_item_info=None):
             profit_dict_list.append({'recipe_dict': recipe_dict, 'profit': alternate_recipe_profit, 'method': recipe_method_dict_list})
 
     if profit_dict_list:
-        profit_dict_list = sorted(profit_dict_list, key=lambda x: x['profit'], reverse=False)
-        profit_dict = profit_dict_list.pop()
+        profit_dict = max(profit_dict_list, key=lambda x: x['profit'])
         method_string = ''
         template = "\n• {type} {count} {item} at {method} for {cost}"
         for profit_method in profit_dict['method']:
@@ -593,52 +1278,112 @@ def generate_unique_id(recipe_id, other_recipe_id=0, size=0):
     return unique_id
 
 
-def vacuum():
-    if verbose:
+def apply_storage_profile():
+    # connection settings for bulk loading: write ahead log, fewer fsyncs, a bigger page cache and memory mapped reads.
+    # auto_vacuum only changes on an existing database at its next full VACUUM, which vacuum() gets round to, and
+    # not even then once the database is in WAL mode, so it's set first.
+    db.query('PRAGMA auto_vacuum = {mode};'.format(mode=storage['auto_vacuum']))
+    db.query('PRAGMA journal_mode = {mode};'.format(mode=storage['journal_mode']))
+    db.query('PRAGMA synchronous = {mode};'.format(mode=storage['synchronous']))
+    db.query('PRAGMA cache_size = {size};'.format(size=storage.getint('cache_size')))
+    db.query('PRAGMA mmap_size = {size};'.format(size=storage.getint('mmap_size')))
+    db.query('PRAGMA temp_store = MEMORY;')
+
+
+def free_page_fraction():
+    page_count = db.query('PRAGMA page_count;').all()[0][0]
+    freelist_count = db.query('PRAGMA freelist_count;').all()[0][0]
+    return freelist_count / page_count if page_count else 0
+
+
+def vacuum(force=False):
+    # reclaims free pages only once they make up vacuum_threshold of the file: with an incremental auto_vacuum
+    # database that's a cheap incremental_vacuum, otherwise a full VACUUM. query planner stats are refreshed either way.
+    fraction = free_page_fraction()
+    if force or fraction >= storage.getfloat('vacuum_threshold'):
         from os.path import getsize
         before = getsize(db.db_url[10:])
-        db.query('VACUUM;')
+        if not force and db.query('PRAGMA auto_vacuum;').all()[0][0] == 2:
+            # frees a page per step, and only executescript steps it to the end.
+            db.db.connection.executescript('PRAGMA incremental_vacuum;')
+        else:
+            db.query('VACUUM;')
+        db.query('PRAGMA wal_checkpoint(TRUNCATE);').all()
         after = getsize(db.db_url[10:])
-        percentage = 1 - after/before
-        print('db cleanup resulted in a {percentage:.3%} reduction in db size'.format(percentage=percentage))
+        if verbose:
+            percentage = 1 - after/before
+            print('db cleanup of {fraction:.1%} free pages resulted in a {percentage:.3%} reduction in db size'.format(
+                fraction=fraction, percentage=percentage
+            ))
+
+    db.query('PRAGMA optimize;')
 
-    else:
-        db.query('VACUUM;')
+
+# applied on import rather than in main, since profit and plan import this module again with a connection of their own.
+apply_storage_profile()
 
 
 if __name__ == '__main__':
+    import profit
+
+    # older databases are brought up to date before anything reads them, the build stages included.
+    table_list = db.get_table_names()
+    if 'recipes' in table_list:
+        if 'recipe_ingredients' not in table_list:
+            index_recipe_ingredients()
+        migrate_component_blobs()
+        migrate_content_hashes()
+        migrate_expansion_depth()
+        migrate_recipe_details()
+        migrate_discipline_steps()
+    if 'items' in table_list:
+        migrate_best_costs()
+
+    if not init_recipes_flag:
+        # earlier versions checkpointed the top up at the end of main too, nothing is resuming so those are stale.
+        clear_checkpoint(stage='recipes')
+
     if init_items_flag:
-        init_items()
-        populate_items()
+        if not checkpoint_started(stage='items'):
+            init_items()
+        missed_items = populate_items()
+        for attempt in range(build_retries):
+            if not missed_items:
+                break
+            missed_items = populate_items(item_id_list=missed_items)
         vendor_pricing()
         trading_post_pricing()
         init_views()
         vacuum()
+        clear_checkpoint(stage='items')
         config['db_only']['init_items_flag'] = 'False'
         with open('config.ini', 'w') as config_file:
             config.write(config_file)
 
     if init_recipes_flag:
-        init_recipes()
+        if not checkpoint_started(stage='recipes'):
+            init_recipes()
         missed_recipes = populate_recipe_table()
-        while missed_recipes:
+        for attempt in range(build_retries):
+            if not missed_recipes:
+                break
             missed_recipes = populate_recipe_table(recipe_list=missed_recipes)
-            vacuum()
+        refresh_best_costs()
+        vacuum()
+        clear_checkpoint(stage='recipes')
         config['db_only']['init_recipes_flag'] = 'False'
         with open('config.ini', 'w') as config_file:
             config.write(config_file)
 
     if add_alt_recipes:
-        added_recipes = True
-        while added_recipes:
-            vacuum()
-            added_recipes = alternate_recipes(debug=True)
+        alternate_recipes(debug=True)
+        vacuum()
         config['db_only']['add_alternate_recipes'] = 'False'
         with open('config.ini', 'w') as config_file:
             config.write(config_file)
 
     if init_items_flag is False and init_recipes_flag is False and add_alt_recipes is False:
-        # trading_post_pricing()    #todo: activate this when live, disabled now for testing (don't need live prices to see if it's working)
+        # profit.refresh_prices()    #todo: activate this when live, disabled now for testing (don't need live prices to see if it's working)
         vacuum()
 
     item_id_list = api_query(payload='', endpoint='item_details')
@@ -648,13 +1393,38 @@ if __name__ == '__main__':
     recipe_list = api_query(payload='', endpoint='recipe_details')
     if verbose:
         print('evaluating profitable recipes')
-    for recipe_id in recipe_list:
-        missed_list = []
-        missed = best_recipe_by_recipe_id(recipe_id=recipe_id)
-        if missed is True:
-            missed_list.append(recipe_id)
+    profit.rescore_recipes()
+    for recipe_id in profit.profitable_game_ids():
+        best_recipe_by_recipe_id(recipe_id=recipe_id)
+
+    if depth_pricing:
+        order_book_pricing()
+        for unique_id in profit.best_unique_ids():
+            batch_dict = profit.size_batch(unique_id=unique_id)
+            if batch_dict['crafts']:
+                print('recipe {game_id}: craft {crafts} for {cost}, sell for {revenue}, profit {profit}'.format(
+                    game_id=batch_dict['game_id'], crafts=batch_dict['crafts'], cost=format_prices(batch_dict['cost']),
+                    revenue=format_prices(batch_dict['revenue']), profit=format_prices(batch_dict['profit'])
+                ))
+
+    if craft_plan:
+        import plan
+
+        if not depth_pricing:
+            order_book_pricing()
+        plan_dict = plan.plan_crafts(stock_dict=plan.account_stock())
+        if plan_dict is None:
+            print('no crafting plan found in {} seconds'.format(plan.plan_time_limit))
+        else:
+            for craft_dict in plan_dict['crafts']:
+                print('recipe {game_id}: craft {crafts:g}'.format(game_id=craft_dict['game_id'], crafts=craft_dict['crafts']))
+            print('plan profit {profit}{note}'.format(profit=format_prices(plan_dict['profit']), note='' if plan_dict['optimal'] else ' (time limit hit, may not be optimal)'))
 
+    init_recipe_variants()
+    known_recipe_set = set(row[0] for row in db.query('SELECT game_id FROM recipes UNION SELECT game_id FROM recipe_variants;').all())
+    missed_list = [recipe_id for recipe_id in recipe_list if recipe_id not in known_recipe_set]
     if missed_list != []:
-        populate_recipe_table(recipe_list=missed_list)
+        populate_recipe_table(recipe_list=missed_list, stage=None)
         vacuum()
 
+    metrics.export()
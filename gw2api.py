@@ -0,0 +1,229 @@
+import json
+import sqlite3
+import threading
+import time
+import configparser
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+base_url = config['api']['base_url'].rstrip('/')
+max_workers = config['api'].getint('max_workers')
+requests_per_second = config['api'].getfloat('requests_per_second')
+request_timeout = config['api'].getfloat('timeout')
+max_retries = config['api'].getint('max_retries')
+
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+
+rate_lock = threading.Lock()
+next_request_time = 0.0
+
+cache_path = config['cache']['path']
+cache_memory_size = config['cache'].getint('memory_size')
+cache_lock = threading.Lock()
+memory_cache = OrderedDict()     # url: (fetched_at, etag, last_modified, body), most recently used last.
+cache_db = None
+
+
+def ids_to_string(id_list):
+    assert isinstance(id_list, (list, tuple))
+    return str(list(id_list))[1:-1].replace(' ', '')    # strips '[' and ']' from str representation.
+
+
+def build_url(payload, endpoint):
+    if endpoint == 'recipes_output':
+        path = "/v2/recipes/search?output={}".format(payload)
+    elif endpoint == 'recipes_input':
+        path = "/v2/recipes/search?input={}".format(payload)
+    elif endpoint == 'recipe_details':
+        path = "/v2/recipes/{}".format(payload)
+    elif endpoint == 'api_recipes':
+        path = "/v2/recipes?access_token={}".format(payload)
+    elif endpoint == 'account_materials':
+        path = "/v2/account/materials?access_token={}".format(payload)
+    elif endpoint == 'item_details':
+        path = "/v2/items/{}".format(payload)
+    elif endpoint == 'item_pricing':
+        path = "/v2/commerce/prices/{}".format(payload)
+    elif endpoint == 'multi_item':
+        path = "/v2/items?ids={}".format(ids_to_string(payload))
+    elif endpoint == 'multi_recipe':
+        path = "/v2/recipes?ids={}".format(ids_to_string(payload))
+    elif endpoint == 'multi_pricing':
+        path = "/v2/commerce/prices?ids={}".format(ids_to_string(payload))
+    elif endpoint == 'multi_listings':
+        path = "/v2/commerce/listings?ids={}".format(ids_to_string(payload))
+    else:
+        assert False
+
+    return base_url + path
+
+
+def wait_for_rate_limit():
+    # spaces request start times evenly, shared by every thread using the session.
+    global next_request_time
+    if requests_per_second <= 0:
+        return
+
+    with rate_lock:
+        now = time.monotonic()
+        start_time = max(now, next_request_time)
+        next_request_time = start_time + 1 / requests_per_second
+
+    if start_time > now:
+        time.sleep(start_time - now)
+
+
+def cache_ttl(endpoint):
+    # seconds a response from the endpoint stays fresh, 0 means it isn't cached.
+    return config['cache'].getint(endpoint, fallback=0)
+
+
+def get_cache_db():
+    global cache_db
+    if cache_db is None:
+        cache_db = sqlite3.connect(cache_path, check_same_thread=False)
+        cache_db.execute("""CREATE TABLE IF NOT EXISTS http_cache (
+    url TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    body TEXT NOT NULL
+);""")
+        cache_db.commit()
+    return cache_db
+
+
+def cache_lookup(url):
+    with cache_lock:
+        entry = memory_cache.get(url)
+        if entry is not None:
+            memory_cache.move_to_end(url)
+            return entry
+
+        row = get_cache_db().execute('SELECT fetched_at, etag, last_modified, body FROM http_cache WHERE url = ?;', (url,)).fetchone()
+        if row is not None:
+            entry = tuple(row)
+            remember(url, entry)
+        return entry
+
+
+def cache_store(url, entry):
+    with cache_lock:
+        remember(url, entry)
+        connection = get_cache_db()
+        connection.execute('INSERT OR REPLACE INTO http_cache (url, fetched_at, etag, last_modified, body) VALUES (?, ?, ?, ?, ?);', (url,) + entry)
+        connection.commit()
+
+
+def remember(url, entry):
+    # caller holds cache_lock.
+    memory_cache[url] = entry
+    memory_cache.move_to_end(url)
+    while len(memory_cache) > cache_memory_size:
+        memory_cache.popitem(last=False)
+
+
+def clear_cache():
+    with cache_lock:
+        memory_cache.clear()
+        connection = get_cache_db()
+        connection.execute('DELETE FROM http_cache;')
+        connection.commit()
+
+
+def request_with_retries(url, headers, endpoint=None):
+    # retries dropped connections, timeouts, throttling and server errors with exponential backoff.
+    # returns None if every attempt failed that way, any other response is returned as is.
+    for attempt in range(max_retries + 1):
+        if attempt:
+            metrics.record_retry(endpoint)
+            time.sleep(2 ** (attempt - 1))
+
+        wait_for_rate_limit()
+        start_time = time.perf_counter()
+        try:
+            result = session.get(url=url, headers=headers, timeout=request_timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            metrics.record_request(endpoint, seconds=time.perf_counter() - start_time, status='error')
+            continue
+        metrics.record_request(endpoint, seconds=time.perf_counter() - start_time, status=result.status_code, size=len(result.content))
+
+        if result.status_code == 429 or result.status_code >= 500:
+            continue
+        return result
+
+    return None
+
+
+def get_json(payload, endpoint, default=None):
+    url = build_url(payload=payload, endpoint=endpoint)
+    ttl = cache_ttl(endpoint)
+
+    headers = {}
+    entry = None
+    if ttl > 0:
+        entry = cache_lookup(url)
+        if entry is not None:
+            fetched_at, etag, last_modified, body = entry
+            if time.time() - fetched_at < ttl:
+                metrics.record_cache_hit(endpoint)
+                return json.loads(body)
+
+            # stale, so ask the server whether it changed rather than downloading it again.
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+    result = request_with_retries(url=url, headers=headers, endpoint=endpoint)
+    if result is None:
+        return default
+    if entry is not None and result.status_code == 304:
+        entry = (time.time(),) + entry[1:]
+        cache_store(url, entry)
+        return json.loads(entry[3])
+
+    try:
+        result.raise_for_status()
+        result_list_or_dict = result.json()
+    except requests.exceptions.HTTPError:
+        return default
+
+    if ttl > 0:
+        cache_store(url, (time.time(), result.headers.get('ETag'), result.headers.get('Last-Modified'), result.text))
+
+    return result_list_or_dict
+
+
+def get_json_chunks(chunks, endpoint, default=None, workers=None):
+    # fetches chunks concurrently but yields (chunk, result) pairs in the order the chunks came in.
+    # at most 2 * workers requests are in flight, so a generator of chunks is never fully materialised.
+    if workers is None:
+        workers = max_workers
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append((chunk, executor.submit(get_json, payload=chunk, endpoint=endpoint, default=default)))
+            if len(in_flight) >= 2 * workers:
+                chunk, future = in_flight.popleft()
+                yield chunk, future.result()
+
+        while in_flight:
+            chunk, future = in_flight.popleft()
+            yield chunk, future.result()
+
+
+def chunk_list(id_list, size=200):
+    # 200 is max paging size per wiki on the api v2.
+    return [id_list[x:x + size] for x in range(0, len(id_list), size)]
@@ -0,0 +1,188 @@
+import re
+import json
+import time
+import threading
+import configparser
+from collections import Counter, defaultdict
+from functools import wraps
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+export_path = config['metrics']['path']
+export_format = config['metrics']['format']
+
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))     # upper bounds in seconds
+
+metrics_lock = threading.Lock()
+api_stats = defaultdict(lambda: {
+    'latency_buckets': [0] * len(latency_buckets), 'latency_sum': 0.0, 'requests': 0, 'bytes': 0,
+    'status_codes': Counter(), 'retries': 0, 'cache_hits': 0
+})
+sql_stats = defaultdict(lambda: {'count': 0, 'seconds': 0.0})      # statement shape: stats
+stage_stats = defaultdict(lambda: {'runs': 0, 'seconds': 0.0})
+
+
+def record_request(endpoint, seconds, status, size=0):
+    # status is the http status code, or 'error' for a dropped connection or timeout.
+    with metrics_lock:
+        stats = api_stats[endpoint]
+        for bucket_index, upper_bound in enumerate(latency_buckets):
+            if seconds <= upper_bound:
+                stats['latency_buckets'][bucket_index] += 1
+                break
+        stats['latency_sum'] += seconds
+        stats['requests'] += 1
+        stats['bytes'] += size
+        stats['status_codes'][str(status)] += 1
+
+
+def record_retry(endpoint):
+    with metrics_lock:
+        api_stats[endpoint]['retries'] += 1
+
+
+def record_cache_hit(endpoint):
+    with metrics_lock:
+        api_stats[endpoint]['cache_hits'] += 1
+
+
+def statement_shape(statement):
+    # statements built with format() differ only in their literals, those are folded so they count as one shape.
+    shape = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    shape = re.sub(r'\b\d+(?:\.\d+)?\b', '?', shape)
+    shape = re.sub(r'\?(?:\s*,\s*\?)+', '?', shape)
+    return ' '.join(shape.split())
+
+
+def watch_engine(engine):
+    # times every statement run through a sqlalchemy engine, such as a records database's _engine.
+    from sqlalchemy import event
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start_times', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_start_times'].pop()
+        with metrics_lock:
+            stats = sql_stats[statement_shape(statement)]
+            stats['count'] += 1
+            stats['seconds'] += seconds
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def timed_stage(function):
+    # records how long each call to a loader takes under the loader's name.
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start_time
+            with metrics_lock:
+                stats = stage_stats[function.__name__]
+                stats['runs'] += 1
+                stats['seconds'] += seconds
+
+    return wrapper
+
+
+def reset():
+    with metrics_lock:
+        api_stats.clear()
+        sql_stats.clear()
+        stage_stats.clear()
+
+
+def metric_lines():
+    # one dict per endpoint, statement shape and stage, as written by export_json_lines.
+    exported_at = time.time()
+    line_list = []
+    with metrics_lock:
+        for endpoint, stats in sorted(api_stats.items()):
+            line_list.append({
+                'type': 'api', 'time': exported_at, 'endpoint': endpoint, 'requests': stats['requests'], 'bytes': stats['bytes'],
+                'retries': stats['retries'], 'cache_hits': stats['cache_hits'], 'status_codes': dict(stats['status_codes']),
+                'latency_sum': stats['latency_sum'],
+                'latency_buckets': {str(upper_bound): count for upper_bound, count in zip(latency_buckets, stats['latency_buckets'])}
+            })
+        for shape, stats in sorted(sql_stats.items(), key=lambda shape_stats: -shape_stats[1]['seconds']):
+            line_list.append({'type': 'sql', 'time': exported_at, 'statement': shape, 'count': stats['count'], 'seconds': stats['seconds']})
+        for stage, stats in sorted(stage_stats.items()):
+            line_list.append({'type': 'stage', 'time': exported_at, 'stage': stage, 'runs': stats['runs'], 'seconds': stats['seconds']})
+
+    return line_list
+
+
+def export_json_lines(path):
+    # appends, so the metrics of successive runs build up in one file.
+    with open(path, 'a') as metrics_file:
+        for line in metric_lines():
+            metrics_file.write(json.dumps(line) + '\n')
+
+
+def label(value):
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+def prometheus_text():
+    line_list = []
+    with metrics_lock:
+        line_list.append('# TYPE gw2_api_request_seconds histogram')
+        for endpoint, stats in sorted(api_stats.items()):
+            cumulative_count = 0
+            for upper_bound, count in zip(latency_buckets, stats['latency_buckets']):
+                cumulative_count += count
+                bound_string = '+Inf' if upper_bound == float('inf') else str(upper_bound)
+                line_list.append('gw2_api_request_seconds_bucket{{endpoint={endpoint},le="{bound}"}} {count}'.format(
+                    endpoint=label(endpoint), bound=bound_string, count=cumulative_count
+                ))
+            line_list.append('gw2_api_request_seconds_sum{{endpoint={endpoint}}} {value}'.format(endpoint=label(endpoint), value=stats['latency_sum']))
+            line_list.append('gw2_api_request_seconds_count{{endpoint={endpoint}}} {value}'.format(endpoint=label(endpoint), value=stats['requests']))
+
+        for metric, key in (('gw2_api_response_bytes_total', 'bytes'), ('gw2_api_retries_total', 'retries'), ('gw2_api_cache_hits_total', 'cache_hits')):
+            line_list.append('# TYPE {metric} counter'.format(metric=metric))
+            for endpoint, stats in sorted(api_stats.items()):
+                line_list.append('{metric}{{endpoint={endpoint}}} {value}'.format(metric=metric, endpoint=label(endpoint), value=stats[key]))
+
+        line_list.append('# TYPE gw2_api_responses_total counter')
+        for endpoint, stats in sorted(api_stats.items()):
+            for status, count in sorted(stats['status_codes'].items()):
+                line_list.append('gw2_api_responses_total{{endpoint={endpoint},status={status}}} {count}'.format(
+                    endpoint=label(endpoint), status=label(status), count=count
+                ))
+
+        for metric, key in (('gw2_db_statements_total', 'count'), ('gw2_db_statement_seconds_total', 'seconds')):
+            line_list.append('# TYPE {metric} counter'.format(metric=metric))
+            for shape, stats in sorted(sql_stats.items()):
+                line_list.append('{metric}{{statement={shape}}} {value}'.format(metric=metric, shape=label(shape), value=stats[key]))
+
+        for metric, key in (('gw2_stage_runs_total', 'runs'), ('gw2_stage_seconds_total', 'seconds')):
+            line_list.append('# TYPE {metric} counter'.format(metric=metric))
+            for stage, stats in sorted(stage_stats.items()):
+                line_list.append('{metric}{{stage={stage}}} {value}'.format(metric=metric, stage=label(stage), value=stats[key]))
+
+    return '\n'.join(line_list) + '\n'
+
+
+def export_prometheus(path):
+    # overwrites, for a node exporter textfile collector to pick up.
+    with open(path, 'w') as metrics_file:
+        metrics_file.write(prometheus_text())
+
+
+def export(path=None, export_format=export_format):
+    # writes to the configured path in the configured format, does nothing if no path is set.
+    if path is None:
+        path = export_path
+    if not path:
+        return
+
+    if export_format == 'prometheus':
+        export_prometheus(path)
+    else:
+        assert export_format == 'json'
+        export_json_lines(path)
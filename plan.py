@@ -0,0 +1,158 @@
+import numpy
+from scipy.optimize import milp, Bounds, LinearConstraint
+from scipy.sparse import coo_array
+
+import db
+import metrics
+import profit
+import recipescan
+
+plan_time_limit = db.config['db_only'].getfloat('plan_time_limit')
+plan_gap = db.config['db_only'].getfloat('plan_gap')
+
+
+def load_base_recipes():
+    # base recipes only, altered ones are chains of base crafts the model can already make out of them.
+    # same layout as profit.load_recipe_matrix.
+    recipe_row_list = db.db.query('SELECT unique_id, game_id, output_item, output_quantity FROM recipes WHERE is_altered = 0 ORDER BY unique_id;').all()
+    recipe_arrays = {
+        'unique_id': numpy.array([row[0] for row in recipe_row_list], dtype=numpy.int64),
+        'game_id': numpy.array([row[1] for row in recipe_row_list], dtype=numpy.int64),
+        'output_item': numpy.array([row[2] for row in recipe_row_list], dtype=numpy.int64),
+        'output_quantity': numpy.array([row[3] for row in recipe_row_list], dtype=numpy.float64),
+    }
+
+    ingredient_row_list = db.db.query("""SELECT recipe_ingredients.unique_id, recipe_ingredients.item_id, recipe_ingredients.count FROM recipe_ingredients
+    JOIN recipes ON recipes.unique_id = recipe_ingredients.unique_id WHERE recipes.is_altered = 0;""").all()
+    ingredient_unique_ids = numpy.array([row[0] for row in ingredient_row_list], dtype=numpy.int64)
+    matrix = {
+        'rows': numpy.searchsorted(recipe_arrays['unique_id'], ingredient_unique_ids),
+        'item_ids': numpy.array([row[1] for row in ingredient_row_list], dtype=numpy.int64),
+        'counts': numpy.array([row[2] for row in ingredient_row_list], dtype=numpy.float64),
+    }
+
+    return recipe_arrays, matrix
+
+
+def ladder_levels(ladder):
+    # (price, quantity) of each level of a profit.Ladder, dropping levels that can't be traded.
+    level_list = []
+    previous_total = 0
+    for price, total_quantity in zip(ladder.prices, ladder.total_quantities):
+        quantity = total_quantity - previous_total
+        previous_total = total_quantity
+        if price is None or price != price or price <= 0 or price == float('inf') or profit.flat_price(price) is None:
+            continue
+        level_list.append((price, quantity))
+
+    return level_list
+
+
+@metrics.timed_stage
+def build_plan_model(stock_dict=None, recipe_arrays=None, matrix=None, ladder_dict=None, max_crafts=None):
+    # one column per base recipe (how many times to craft it), one per order book level an ingredient can be bought
+    # from and one per level an output or stocked item can be sold to. one row per item: stock plus what's bought and
+    # crafted has to cover what's used and sold. the matrix is built in coordinate form straight from the arrays.
+    if stock_dict is None:
+        stock_dict = {}
+    if recipe_arrays is None or matrix is None:
+        recipe_arrays, matrix = load_base_recipes()
+    if max_crafts is None:
+        max_crafts = profit.max_batch
+
+    buy_item_ids = numpy.unique(matrix['item_ids'])
+    sell_item_ids = numpy.union1d(recipe_arrays['output_item'], numpy.array(sorted(stock_dict), dtype=numpy.int64))
+    item_ids = numpy.union1d(buy_item_ids, sell_item_ids)
+    if ladder_dict is None:
+        ladder_dict = profit.load_ladders([int(item_id) for item_id in item_ids])
+
+    recipe_count = len(recipe_arrays['unique_id'])
+    row_list = [numpy.searchsorted(item_ids, recipe_arrays['output_item']), numpy.searchsorted(item_ids, matrix['item_ids'])]
+    column_list = [numpy.arange(recipe_count), matrix['rows']]
+    value_list = [recipe_arrays['output_quantity'], -matrix['counts']]
+
+    # level columns follow the craft columns, buys then sells.
+    level_item_list = []
+    level_price_list = []
+    level_quantity_list = []
+    level_sign_list = []
+    for ladder_side, sign, side_item_ids in ((0, 1, buy_item_ids), (1, -1, sell_item_ids)):
+        for item_id in side_item_ids:
+            if int(item_id) not in ladder_dict:
+                continue
+            for price, quantity in ladder_levels(ladder_dict[int(item_id)][ladder_side]):
+                level_item_list.append(item_id)
+                level_price_list.append(price)
+                level_quantity_list.append(quantity)
+                level_sign_list.append(sign)
+
+    level_signs = numpy.array(level_sign_list, dtype=numpy.float64)
+    row_list.append(numpy.searchsorted(item_ids, numpy.array(level_item_list, dtype=numpy.int64)))
+    column_list.append(recipe_count + numpy.arange(len(level_sign_list)))
+    value_list.append(level_signs)
+
+    column_count = recipe_count + len(level_sign_list)
+    constraint_matrix = coo_array(
+        (numpy.concatenate(value_list), (numpy.concatenate(row_list), numpy.concatenate(column_list))),
+        shape=(len(item_ids), column_count)
+    ).tocsr()   # duplicates, an item a recipe both uses and makes, are summed here
+
+    stock = numpy.zeros(len(item_ids))
+    for item_id, quantity in stock_dict.items():
+        stock[numpy.searchsorted(item_ids, item_id)] = quantity
+
+    # milp minimises, so buying costs its price and selling earns it.
+    objective = numpy.concatenate([numpy.zeros(recipe_count), level_signs * numpy.array(level_price_list, dtype=numpy.float64)])
+    upper_bounds = numpy.concatenate([numpy.full(recipe_count, max_crafts, dtype=numpy.float64), numpy.array(level_quantity_list, dtype=numpy.float64)])
+
+    return {
+        'recipe_arrays': recipe_arrays, 'item_ids': item_ids, 'level_items': numpy.array(level_item_list, dtype=numpy.int64), 'level_signs': level_signs,
+        'objective': objective, 'constraint': LinearConstraint(constraint_matrix, lb=-stock, ub=numpy.inf),
+        'bounds': Bounds(numpy.zeros(column_count), upper_bounds),
+        'integrality': numpy.concatenate([numpy.ones(recipe_count), numpy.zeros(len(level_sign_list))])
+    }
+
+
+@metrics.timed_stage
+def plan_crafts(stock_dict=None, integral=True, time_limit=None, gap=None, model=None):
+    # the most profitable set of crafts when recipes compete for the same stock and order book depth. craft counts
+    # are integers unless integral is False, which solves the lp relaxation instead. the solver stops once its plan
+    # is provably within gap (a fraction) of the best possible. returns the plan's profit and crafts, buys and sells,
+    # or None if the solver found no plan in time.
+    if model is None:
+        model = build_plan_model(stock_dict=stock_dict)
+    if time_limit is None:
+        time_limit = plan_time_limit
+    if gap is None:
+        gap = plan_gap
+
+    integrality = model['integrality'] if integral else numpy.zeros(len(model['integrality']))
+    result = milp(c=model['objective'], constraints=model['constraint'], integrality=integrality, bounds=model['bounds'],
+                  options={'time_limit': time_limit, 'mip_rel_gap': gap})
+    if result.x is None:
+        return None
+
+    recipe_arrays = model['recipe_arrays']
+    recipe_count = len(recipe_arrays['unique_id'])
+    craft_values = numpy.round(result.x[:recipe_count]) if integral else result.x[:recipe_count]
+    level_values = result.x[recipe_count:]
+
+    craft_list = []
+    for index in numpy.flatnonzero(craft_values > 1e-9):
+        craft_list.append({'unique_id': int(recipe_arrays['unique_id'][index]), 'game_id': int(recipe_arrays['game_id'][index]), 'crafts': craft_values[index]})
+
+    buy_dict = {}
+    sell_dict = {}
+    for item_id, sign, quantity in zip(model['level_items'], model['level_signs'], level_values):
+        if quantity > 1e-9:
+            side_dict = buy_dict if sign > 0 else sell_dict
+            side_dict[int(item_id)] = side_dict.get(int(item_id), 0) + quantity
+
+    return {'profit': -result.fun, 'optimal': result.status == 0, 'crafts': craft_list, 'buys': buy_dict, 'sells': sell_dict}
+
+
+def account_stock():
+    # material storage of the account recipescan's api key belongs to, nothing without a key.
+    if not recipescan.api_key:
+        return {}
+    return recipescan.get_material_storage(api=recipescan.api_key)
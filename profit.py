@@ -0,0 +1,354 @@
+from bisect import bisect_left
+from itertools import accumulate
+
+import numpy
+
+import db
+import metrics
+
+max_batch = db.config['db_only'].getint('max_batch')
+rank_columns = ('profit', 'roi', 'profit_per_hour')
+
+
+def load_price_arrays():
+    # dense arrays indexed by item id. items without a row cost infinity and sell for nothing.
+    price_row_list = db.db.query("""SELECT items.item_id, item_best_cost.buy_cost, items.tp_value, items.vendor_value
+    FROM items JOIN item_best_cost ON item_best_cost.item_id = items.item_id;""").all()
+    size = max((row[0] for row in price_row_list), default=0) + 1
+
+    cost_array = numpy.full(size, numpy.inf)
+    value_array = numpy.zeros(size)
+    for item_id, best_cost, tp_value, vendor_value in price_row_list:
+        cost_array[item_id] = best_cost
+        value_array[item_id] = max(tp_value or 0, vendor_value or 0)
+
+    return cost_array, value_array
+
+
+def load_recipe_matrix(marked_only=False):
+    # recipes sorted by unique_id, plus the ingredients as a sparse matrix in coordinate form:
+    # row i of the matrix holds counts[j] of item_ids[j] for every j where rows[j] == i.
+    # with marked_only, just the recipes picked out by mark_recipes_for_items are loaded.
+    if marked_only:
+        where_string = 'WHERE unique_id IN (SELECT unique_id FROM rescore_recipes)'
+    else:
+        where_string = ''
+
+    recipe_row_list = db.db.query('SELECT unique_id, game_id, output_item, output_quantity, time_to_craft_ms FROM recipes {where} ORDER BY unique_id;'.format(
+        where=where_string
+    )).all()
+    recipe_arrays = {
+        'unique_id': numpy.array([row[0] for row in recipe_row_list], dtype=numpy.int64),
+        'game_id': numpy.array([row[1] for row in recipe_row_list], dtype=numpy.int64),
+        'output_item': numpy.array([row[2] for row in recipe_row_list], dtype=numpy.int64),
+        'output_quantity': numpy.array([row[3] for row in recipe_row_list], dtype=numpy.int64),
+        'time_to_craft_ms': numpy.array([numpy.nan if row[4] is None else row[4] for row in recipe_row_list], dtype=numpy.float64),
+    }
+
+    ingredient_row_list = db.db.query('SELECT unique_id, item_id, count FROM recipe_ingredients {where};'.format(where=where_string)).all()
+    ingredient_unique_ids = numpy.array([row[0] for row in ingredient_row_list], dtype=numpy.int64)
+    matrix = {
+        'rows': numpy.searchsorted(recipe_arrays['unique_id'], ingredient_unique_ids),
+        'item_ids': numpy.array([row[1] for row in ingredient_row_list], dtype=numpy.int64),
+        'counts': numpy.array([row[2] for row in ingredient_row_list], dtype=numpy.float64),
+    }
+
+    return recipe_arrays, matrix
+
+
+def price_lookup(price_array, item_ids, missing):
+    # item ids past the end of the array have never been priced.
+    result = numpy.full(len(item_ids), missing, dtype=numpy.float64)
+    in_range = item_ids < len(price_array)
+    result[in_range] = price_array[item_ids[in_range]]
+    return result
+
+
+def evaluate_recipes(recipe_arrays=None, matrix=None, cost_array=None, value_array=None):
+    # cost, revenue, profit and roi of every recipe in the table, base and altered, in one pass.
+    if recipe_arrays is None or matrix is None:
+        recipe_arrays, matrix = load_recipe_matrix()
+    if cost_array is None or value_array is None:
+        cost_array, value_array = load_price_arrays()
+
+    recipe_count = len(recipe_arrays['unique_id'])
+    ingredient_costs = matrix['counts'] * price_lookup(cost_array, matrix['item_ids'], missing=numpy.inf)
+    cost = numpy.bincount(matrix['rows'], weights=ingredient_costs, minlength=recipe_count)
+
+    output_values = price_lookup(value_array, recipe_arrays['output_item'], missing=0)
+    revenue = output_values * recipe_arrays['output_quantity']
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        profit = revenue - cost
+        roi = profit / cost
+        profit_per_hour = numpy.where(recipe_arrays['time_to_craft_ms'] > 0, profit / (recipe_arrays['time_to_craft_ms'] / 3600000), numpy.nan)
+
+    result = dict(recipe_arrays)
+    result.update({'cost': cost, 'revenue': revenue, 'profit': profit, 'roi': roi, 'profit_per_hour': profit_per_hour})
+    return result
+
+
+def best_by_game_id(result):
+    # index of the most profitable variant of each game recipe.
+    order = numpy.lexsort((-result['profit'], result['game_id']))
+    sorted_game_ids = result['game_id'][order]
+    first_of_group = numpy.ones(len(order), dtype=bool)
+    first_of_group[1:] = sorted_game_ids[1:] != sorted_game_ids[:-1]
+    return order[first_of_group]
+
+
+def profitable_game_ids(result=None, min_profit=0):
+    # from an evaluate_recipes result if one is given, otherwise from the recipe_profit table.
+    if result is None:
+        game_id_row_list = db.db.query(
+            'SELECT game_id FROM recipe_profit GROUP BY game_id HAVING MAX(profit) > :min_profit ORDER BY game_id;',
+            min_profit=min_profit
+        ).all()
+        return [row[0] for row in game_id_row_list]
+
+    best_index = best_by_game_id(result)
+    profitable_index = best_index[result['profit'][best_index] > min_profit]
+    return [int(game_id) for game_id in result['game_id'][profitable_index]]
+
+
+def init_recipe_profit():
+    db.db.query('DROP TABLE IF EXISTS recipe_profit;')
+    db.db.query("""CREATE TABLE recipe_profit (
+    unique_id INTEGER PRIMARY KEY,
+    game_id INTEGER NOT NULL,
+    output_item INTEGER NOT NULL,
+    cost REAL,
+    revenue REAL,
+    profit REAL,
+    roi REAL,
+    profit_per_hour REAL
+);""")
+    db.db.query('CREATE INDEX recipe_profit_game_id ON recipe_profit (game_id);')
+    for rank_by in rank_columns:
+        db.db.query('CREATE INDEX recipe_profit_{rank_by} ON recipe_profit ({rank_by});'.format(rank_by=rank_by))
+
+
+def mark_recipes_for_items(item_id_list):
+    # fills the rescore_recipes temp table with every recipe that uses or outputs one of the items.
+    db.db.query('CREATE TEMP TABLE IF NOT EXISTS rescore_items (item_id INTEGER PRIMARY KEY);')
+    db.db.query('CREATE TEMP TABLE IF NOT EXISTS rescore_recipes (unique_id INTEGER PRIMARY KEY);')
+    with db.db.transaction():
+        db.db.query('DELETE FROM rescore_items;')
+        db.db.query('DELETE FROM rescore_recipes;')
+        db.db.bulk_query('INSERT INTO rescore_items (item_id) VALUES (:item_id);', [{'item_id': item_id} for item_id in item_id_list])
+        db.db.query("""INSERT OR IGNORE INTO rescore_recipes (unique_id)
+    SELECT unique_id FROM recipe_ingredients WHERE item_id IN (SELECT item_id FROM rescore_items);""")
+        db.db.query("""INSERT OR IGNORE INTO rescore_recipes (unique_id)
+    SELECT unique_id FROM recipes WHERE output_item IN (SELECT item_id FROM rescore_items);""")
+
+
+def save_recipe_profit(result, replace_all=False):
+    def nan_to_none(value):
+        return None if value != value else value
+
+    profit_row_list = [
+        {'unique_id': unique_id, 'game_id': game_id, 'output_item': output_item, 'cost': nan_to_none(cost), 'revenue': nan_to_none(revenue),
+         'profit': nan_to_none(profit), 'roi': nan_to_none(roi), 'profit_per_hour': nan_to_none(profit_per_hour)}
+        for unique_id, game_id, output_item, cost, revenue, profit, roi, profit_per_hour in zip(
+            result['unique_id'].tolist(), result['game_id'].tolist(), result['output_item'].tolist(), result['cost'].tolist(),
+            result['revenue'].tolist(), result['profit'].tolist(), result['roi'].tolist(), result['profit_per_hour'].tolist()
+        )
+    ]
+
+    with db.db.transaction():
+        if replace_all:
+            db.db.query('DELETE FROM recipe_profit;')
+        if profit_row_list:
+            db.db.bulk_query("""INSERT OR REPLACE INTO recipe_profit (unique_id, game_id, output_item, cost, revenue, profit, roi, profit_per_hour)
+    VALUES (:unique_id, :game_id, :output_item, :cost, :revenue, :profit, :roi, :profit_per_hour);""", profit_row_list)
+
+
+@metrics.timed_stage
+def rescore_recipes(changed_item_ids=None):
+    # recomputes recipe_profit. with changed_item_ids only recipes that use or output those items are rescored,
+    # with None (or before recipe_profit exists) every recipe is. returns the number of recipes scored.
+    if 'recipe_profit' not in db.db.get_table_names() or 'profit_per_hour' not in [
+        column['name'] for column in db.db.query('PRAGMA table_info(recipe_profit);').as_dict()
+    ]:
+        init_recipe_profit()
+        changed_item_ids = None
+
+    if changed_item_ids is None:
+        recipe_arrays, matrix = load_recipe_matrix()
+    elif not changed_item_ids:
+        return 0
+    else:
+        mark_recipes_for_items(item_id_list=changed_item_ids)
+        recipe_arrays, matrix = load_recipe_matrix(marked_only=True)
+
+    result = evaluate_recipes(recipe_arrays=recipe_arrays, matrix=matrix)
+    save_recipe_profit(result=result, replace_all=changed_item_ids is None)
+
+    if db.verbose:
+        print('rescored {count} recipes'.format(count=len(result['unique_id'])))
+
+    return len(result['unique_id'])
+
+
+def top_recipes(k=50, rank_by='profit', discipline=None, needs_recipe=None):
+    # the k best game recipes in recipe_profit by rank_by, each as its best variant's row. walks the rank_by index from
+    # the top and stops as soon as k distinct game recipes pass the filters, so nothing is sorted or fully scanned.
+    # discipline keeps recipes that discipline can craft every step of, needs_recipe keeps those that do or don't need
+    # learning.
+    assert rank_by in rank_columns
+    where_string = 'recipe_profit.{rank_by} IS NOT NULL'.format(rank_by=rank_by)
+    if discipline is not None:
+        # any step that discipline can craft gets a row through, db.can_craft then checks it can craft all of them.
+        where_string += " AND ',' || REPLACE(recipes.disciplines, ';', ',') || ',' LIKE :discipline_pattern"
+    if needs_recipe is not None:
+        where_string += ' AND recipes.needs_recipe = :needs_recipe'
+
+    ranked_rows = db.db.query("""SELECT recipe_profit.*, recipes.disciplines, recipes.needs_recipe
+    FROM recipe_profit JOIN recipes ON recipes.unique_id = recipe_profit.unique_id
+    WHERE {where} ORDER BY recipe_profit.{rank_by} DESC;""".format(where=where_string, rank_by=rank_by),
+        discipline_pattern='%,{discipline},%'.format(discipline=discipline), needs_recipe=int(bool(needs_recipe))
+    )
+
+    top_list = []
+    seen_game_ids = set()
+    for ranked_row in ranked_rows:
+        if discipline is not None and not db.can_craft(ranked_row['disciplines'], discipline):
+            continue
+        if ranked_row['game_id'] in seen_game_ids:
+            continue
+        seen_game_ids.add(ranked_row['game_id'])
+        top_list.append(ranked_row.as_dict())
+        if len(top_list) == k:
+            break
+
+    return top_list
+
+
+def refresh_prices():
+    # polls trading post prices and rescores only what the changes touch.
+    changed_item_ids = db.trading_post_pricing()
+    return rescore_recipes(changed_item_ids=changed_item_ids)
+
+
+class Ladder(object):
+    # one side of an order book, best price first, with running totals so the coin needed to fill the first n units
+    # is one binary search. a final level with no quantity limit stands for a vendor, which never runs out.
+
+    def __init__(self, prices, quantities):
+        self.prices = list(prices)
+        self.total_quantities = list(accumulate(quantities))
+        self.total_coins = list(accumulate(price * quantity if quantity != float('inf') else 0 for price, quantity in zip(self.prices, quantities)))
+
+    def depth(self):
+        return self.total_quantities[-1] if self.total_quantities else 0
+
+    def total(self, count):
+        # coin to fill count units from the best price down, infinite if the book isn't that deep.
+        if count <= 0:
+            return 0
+        level = bisect_left(self.total_quantities, count)
+        if level == len(self.total_quantities):
+            return float('inf')
+        if level == 0:
+            return count * self.prices[0]
+        return self.total_coins[level - 1] + (count - self.total_quantities[level - 1]) * self.prices[level]
+
+
+def flat_price(price, ceiling=1234567890):
+    # init_items fills unknown vendor and karma costs with huge placeholders, those mean not for sale.
+    if price is None or price >= ceiling:
+        return None
+    return price
+
+
+def load_ladders(item_id_list):
+    # item_id: (cost ladder for buying it, revenue ladder for selling it). trading post levels come from the stored
+    # order books, and a vendor or karma merchant is an unlimited level behind them. items without a book fall back
+    # to the single best price item_best_cost and items hold for them.
+    book_dict = db.load_order_books(item_id_list)
+    ladder_dict = {}
+    for item_id_chunk in db.gw2api.chunk_list(sorted(set(item_id_list)), size=500):
+        item_row_list = db.db.query("""SELECT items.item_id, vendor_cost, karma_cost, vendor_value, tp_value, buy_cost
+    FROM items JOIN item_best_cost ON item_best_cost.item_id = items.item_id WHERE items.item_id IN ({ids});""".format(
+            ids=db.gw2api.ids_to_string(item_id_chunk)
+        )).all()
+        for item_id, vendor_cost, karma_cost, vendor_value, tp_value, buy_cost in item_row_list:
+            if item_id not in book_dict:
+                ladder_dict[item_id] = (Ladder([buy_cost], [float('inf')]), Ladder([max(tp_value or 0, vendor_value or 0)], [float('inf')]))
+                continue
+
+            buy_prices, buy_quantities, sell_prices, sell_quantities = book_dict[item_id]
+            unlimited_costs = [price for price in (flat_price(vendor_cost), flat_price(karma_cost / float(db.karma_conversion))) if price is not None]
+            cost_levels = list(zip(sell_prices, sell_quantities))
+            if unlimited_costs:
+                unlimited_cost = min(unlimited_costs)
+                cost_levels = [level for level in cost_levels if level[0] < unlimited_cost] + [(unlimited_cost, float('inf'))]
+            revenue_levels = [level for level in zip(buy_prices, buy_quantities) if level[0] > (vendor_value or 0)] + [(vendor_value or 0, float('inf'))]
+
+            ladder_dict[item_id] = (
+                Ladder([level[0] for level in cost_levels], [level[1] for level in cost_levels]),
+                Ladder([level[0] for level in revenue_levels], [level[1] for level in revenue_levels])
+            )
+
+    return ladder_dict
+
+
+def batch_totals(recipe_dict, crafts, ladder_dict):
+    # (cost, revenue) of crafting a recipe crafts times, buying every ingredient and selling every output through the books.
+    cost = 0
+    for item_id, count in zip(*db.unpack_components(recipe_dict['component_blob'])):
+        if item_id not in ladder_dict:
+            return float('inf'), 0
+        cost += ladder_dict[item_id][0].total(count * crafts)
+
+    if recipe_dict['output_item'] not in ladder_dict:
+        return cost, 0
+    revenue = ladder_dict[recipe_dict['output_item']][1].total(recipe_dict['output_quantity'] * crafts)
+    return cost, revenue
+
+
+def max_profitable_crafts(recipe_dict, ladder_dict, limit=None):
+    # each extra craft buys further up the sells and sells further down the buys, so the profit it adds never goes up.
+    # that makes the last craft worth doing a binary search over how many crafts, not a walk.
+    if limit is None:
+        limit = max_batch
+    for item_id, count in zip(*db.unpack_components(recipe_dict['component_blob'])):
+        # a ladder ending in an unlimited level, a vendor or an item without a book, never runs out.
+        if item_id in ladder_dict and ladder_dict[item_id][0].depth() != float('inf'):
+            limit = min(limit, int(ladder_dict[item_id][0].depth() // count))
+
+    def marginal_profit(crafts):
+        cost, revenue = batch_totals(recipe_dict, crafts, ladder_dict)
+        previous_cost, previous_revenue = batch_totals(recipe_dict, crafts - 1, ladder_dict)
+        return (revenue - previous_revenue) - (cost - previous_cost)
+
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if marginal_profit(middle) > 0:
+            low = middle
+        else:
+            high = middle - 1
+
+    return low
+
+
+def size_batch(unique_id, ladder_dict=None):
+    # how many times to craft a recipe and what that batch costs and earns, priced through the order books.
+    recipe_dict = db.db.query('SELECT unique_id, game_id, output_item, output_quantity, component_blob FROM recipes WHERE unique_id = :unique_id;',
+                              unique_id=unique_id).as_dict()[0]
+    if ladder_dict is None:
+        ladder_dict = load_ladders([recipe_dict['output_item']] + list(db.unpack_components(recipe_dict['component_blob'])[0]))
+
+    crafts = max_profitable_crafts(recipe_dict, ladder_dict)
+    cost, revenue = batch_totals(recipe_dict, crafts, ladder_dict)
+    return {'unique_id': unique_id, 'game_id': recipe_dict['game_id'], 'crafts': crafts, 'cost': cost, 'revenue': revenue, 'profit': revenue - cost}
+
+
+def best_unique_ids(min_profit=0):
+    # the most profitable variant of every game recipe in recipe_profit that clears min_profit.
+    unique_id_row_list = db.db.query(
+        'SELECT unique_id, MAX(profit) FROM recipe_profit GROUP BY game_id HAVING MAX(profit) > :min_profit ORDER BY game_id;',
+        min_profit=min_profit
+    ).all()
+    return [row[0] for row in unique_id_row_list]
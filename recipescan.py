@@ -1,11 +1,34 @@
-import requests
+import heapq
+import configparser
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import gw2api
+import metrics
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+api_key = config['scan_only'].get('api_key', '')
 
 global profitable_recipes_dict
-global processed_item_ingredients_dict
+global recipe_details_dict
+global recipe_output_dict
 global vendor_items_dict
+global used_in_dict
+global successor_dict
+global successor_output_dict
+global recipe_output_complete
+global worker_prices
 
 profitable_recipes_dict = {}
-processed_item_ingredients_dict = {}
+recipe_details_dict = {}    # recipe_id: recipe dict, filled by get_recipes_bulk
+recipe_output_dict = {}     # item_id: ids of the recipes that make it, filled by collect_recipe_item_ids
+recipe_output_complete = False      # True once build_used_in_index has loaded every recipe, so unlisted items have none
+used_in_dict = {}           # item_id: {recipe_id: how many one craft takes}, filled by build_used_in_index
+successor_dict = {}         # item_id: successor_recipes result
+successor_output_dict = {}  # item_id: successor_outputs result
+worker_prices = None        # the snapshot a scoring worker process was handed
 
 vendor_items_dict = {
     12157: 8,
@@ -74,30 +97,7 @@ vendor_items_dict = {
 
 
 def api_query(payload, api_endpoint):
-
-    if api_endpoint == 'recipes_output':
-        url = "https://api.guildwars2.com/v2/recipes/search?output={}".format(payload)
-    elif api_endpoint == 'recipes_input':
-        url = "https://api.guildwars2.com/v2/recipes/search?input={}".format(payload)
-    elif api_endpoint == 'recipe_details':
-        url = "https://api.guildwars2.com/v2/recipes/{}".format(payload)
-    elif api_endpoint == 'api_recipes':
-        url = "https://api.guildwars2.com/v2/recipes?access_token={}".format(payload)
-    elif api_endpoint == 'item_details':
-        url = "https://api.guildwars2.com/v2/items/{}".format(payload)
-    elif api_endpoint == 'item_pricing':
-        url = "https://api.guildwars2.com/v2/commerce/prices/{}".format(payload)
-    else:
-        assert False
-
-    result = requests.get(url=url)
-    try:
-        result.raise_for_status()
-        result_dict = result.json()
-    except requests.exceptions.HTTPError:
-        result_dict = None
-
-    return result_dict
+    return gw2api.get_json(payload=payload, endpoint=api_endpoint, default=None)
 
 
 def get_recipes(api=''):
@@ -110,10 +110,45 @@ def get_recipes(api=''):
 def parse_recipe(recipe_id):
     assert isinstance(recipe_id, int)
 
-    recipe_dict = api_query(payload=recipe_id, api_endpoint='recipe_details')
+    recipe_dict = recipe_details_dict.get(recipe_id)
+    if recipe_dict is None:
+        recipe_dict = api_query(payload=recipe_id, api_endpoint='recipe_details')
     return recipe_dict
 
 
+def get_recipes_bulk(recipe_list):
+    # fetches recipes 200 at a time, parse_recipe then finds them without a request of its own.
+    missing_recipe_list = [recipe_id for recipe_id in recipe_list if recipe_id not in recipe_details_dict]
+    chunk_results = gw2api.get_json_chunks(chunks=gw2api.chunk_list(missing_recipe_list), endpoint='multi_recipe', default=[])
+    for chunk, recipe_dict_list in chunk_results:
+        for recipe_dict in recipe_dict_list:
+            recipe_details_dict[recipe_dict['id']] = recipe_dict
+
+    return [recipe_details_dict[recipe_id] for recipe_id in recipe_list if recipe_id in recipe_details_dict]
+
+
+def collect_recipe_item_ids(recipe_dict_list):
+    # every item a set of recipes could need priced: outputs, ingredients, and the ingredients of any recipe that
+    # makes an ingredient, all the way down. recipes found along the way are fetched in bulk a level at a time.
+    item_id_set = set()
+    frontier = list(recipe_dict_list)
+    while frontier:
+        new_item_id_list = []
+        for recipe_dict in frontier:
+            for item_id in [recipe_dict['output_item_id']] + [ingredient['item_id'] for ingredient in recipe_dict['ingredients']]:
+                if item_id not in item_id_set:
+                    item_id_set.add(item_id)
+                    new_item_id_list.append(item_id)
+
+        sub_recipe_list = []
+        for item_id in new_item_id_list:
+            recipe_output_dict[item_id] = get_recipe_output(item_id=item_id) or []
+            sub_recipe_list.extend(recipe_output_dict[item_id])
+        frontier = get_recipes_bulk(sub_recipe_list)
+
+    return item_id_set
+
+
 def parse_item(item_id):
     assert isinstance(item_id, int)
 
@@ -124,28 +159,75 @@ def parse_item(item_id):
 def get_recipe_output(item_id):
     assert isinstance(item_id, int)
 
-    recipe_list = api_query(payload=item_id, api_endpoint='recipes_output')
+    recipe_list = recipe_output_dict.get(item_id)
+    if recipe_list is None and recipe_output_complete:
+        recipe_list = []
+    if recipe_list is None:
+        recipe_list = api_query(payload=item_id, api_endpoint='recipes_output')
     return recipe_list
 
 
-def get_item_price(item_id, listing_type=None):
+class PriceSnapshot(object):
+    # trading post prices for a set of items, fetched 200 at a time with the ids= endpoint.
+    # prices sit in two arrays indexed through index_dict, with vendor_items_dict already applied to sells.
+    # resolutions made with these prices are memoised on the snapshot, so they're dropped along with it.
+
+    def __init__(self, item_ids=()):
+        self.index_dict = {}
+        self.buys = array('d')
+        self.sells = array('d')
+        self.resolved_item_dict = {}
+        self.fetch(item_ids)
+
+    def fetch(self, item_ids):
+        missing_item_list = sorted(set(item_id for item_id in item_ids if item_id not in self.index_dict))
+        chunk_results = gw2api.get_json_chunks(chunks=gw2api.chunk_list(missing_item_list), endpoint='multi_pricing', default=[])
+        for chunk, pricing_dict_list in chunk_results:
+            pricing_dict_by_id = {pricing_dict['id']: pricing_dict for pricing_dict in pricing_dict_list}
+            for item_id in chunk:
+                pricing_dict = pricing_dict_by_id.get(item_id)
+                if pricing_dict:
+                    buy_price = pricing_dict['buys']['unit_price']
+                    sell_price = pricing_dict['sells']['unit_price']
+                else:   # not listed on the trading post, see get_item_price.
+                    buy_price = -float('inf')
+                    sell_price = float('inf')
+
+                self.index_dict[item_id] = len(self.buys)
+                self.buys.append(buy_price)
+                self.sells.append(item_from_vendor(item_id=item_id, price=sell_price))
+
+    def price(self, item_id, listing_type):
+        if item_id not in self.index_dict:
+            self.fetch([item_id])
+
+        if listing_type == 'buys':
+            return self.buys[self.index_dict[item_id]]
+        else:
+            return self.sells[self.index_dict[item_id]]
+
+
+def get_item_price(item_id, listing_type=None, prices=None):
     assert isinstance(item_id, int)
     assert listing_type in ['buys', 'sells']
     # you BUY instantly from sells and you SELL instantly to buys
 
+    if prices is not None:
+        return prices.price(item_id=item_id, listing_type=listing_type)
+
     sale_dict = api_query(payload=item_id, api_endpoint='item_pricing')
     if sale_dict:
         price = sale_dict[listing_type]['unit_price']
     elif sale_dict is None:
         price = float('inf')
-        if listing_type is 'buys':
+        if listing_type == 'buys':
             price = -price
         '''
         item_price will be None if the item isn't listed on the trading post.
         since this means the cost for it is infinite, setting the price to infinity is the easiest move.
         '''
 
-    if listing_type is 'sells':
+    if listing_type == 'sells':
         price = item_from_vendor(item_id=item_id, price=price)
     return price
 
@@ -159,91 +241,125 @@ def item_from_vendor(item_id, price=0):
     return true_price
 
 
-def get_recipe_price(ingredient_dict, skip_list=[]):
+def get_recipe_price(ingredient_dict, skip_list=[], prices=None):
     price = 0
     for item_id, quantity in ingredient_dict.items():
         if item_id in skip_list:
-            price = 0
+            continue
         else:
             try:
-                price += quantity * get_item_price(item_id=item_id, listing_type='sells')
+                price += quantity * get_item_price(item_id=item_id, listing_type='sells', prices=prices)
             except TypeError:
                 pass
 
     return price
 
 
-def compare_item_to_ingredients(item, skip_list=[]):
-    item_id = item['item_id']
-    quantity = item['count']
-    cheapest_ingredient_dict = {}
-
-    try:
-        cached_ingredient_dict = processed_item_ingredients_dict[item_id]
-        for cached_item_id, cached_quantity in cached_ingredient_dict.items():
-            cheapest_ingredient_dict[cached_item_id] = quantity * cached_quantity
-    except LookupError:     # item not yet in the dict
-        output_recipe_list = get_recipe_output(item_id=item_id)
-        if output_recipe_list:
-            result_price = quantity * get_item_price(item_id=item_id, listing_type='sells')
-            cheapest_ingredient_dict = {item_id: quantity}
-
-            # all recipes in the list will be identical crafting discipline specific variants of the same recipe.
-            component_recipe_id = output_recipe_list[0]
-
-            cheapest_component_recipe_dict = base_recipe_list(recipe_input=component_recipe_id)
-
-            component_total_price = 0
-            for component_item_id, component_quantity in cheapest_component_recipe_dict.items():
-                component_item_price = get_item_price(item_id=component_item_id, listing_type='sells')
-                component_total_price += component_item_price * component_quantity
-
-            if skip_list:
-                for skip_item_id in skip_list:
-                    if skip_item_id in cheapest_component_recipe_dict.keys():
-                        cheapest_ingredient_dict = cheapest_component_recipe_dict
-                        processed_item_ingredients_dict[item_id] = cheapest_ingredient_dict
-
-            else:
-                if component_total_price < result_price:
-                    cheapest_ingredient_dict = cheapest_component_recipe_dict
-                    processed_item_ingredients_dict[item_id] = cheapest_ingredient_dict
-
-        else:
-            cheapest_ingredient_dict[item_id] = quantity
-            processed_item_ingredients_dict[item_id] = {item_id: 1}
-
-    return cheapest_ingredient_dict
-
-
-def base_recipe_list(recipe_input, skip_list=[]):
+def relevant_skip_set(item_id, skip_set):
+    # the part of skip_set a resolution of item_id can run into: the item itself and anything it can be crafted from.
+    # once build_used_in_index has loaded every recipe that's known, and memo keys use it, so a resolution that never
+    # reaches a skipped item is shared with every other skip set, an empty one included.
+    if not skip_set or not recipe_output_complete:
+        return skip_set
+    return frozenset(skip_id for skip_id in skip_set if skip_id == item_id or item_id in successor_outputs(skip_id))
+
+
+def successor_outputs(item_id):
+    # every item crafted, directly or not, from item_id.
+    output_set = successor_output_dict.get(item_id)
+    if output_set is None:
+        output_set = set(recipe_details_dict[recipe_id]['output_item_id'] for recipe_id in successor_recipes(item_id)[0])
+        successor_output_dict[item_id] = output_set
+    return output_set
+
+
+def resolve_item(item_id, skip_set=frozenset(), in_progress=None, prices=None):
+    # cheapest way to get one of the item: buy it, or craft it from the cheapest resolution of each ingredient of
+    # any of its recipes. items in skip_set are already owned, so they cost nothing and are never broken down.
+    # returns (cost, {base item id: quantity}, cycle), cycle is True if the answer depended on cutting a loop of
+    # convertible materials short, in which case it isn't memoised. resolutions are memoised on prices as
+    # (item_id, relevant_skip_set): (cost of one, {base item id: quantity needed for one}). without prices a snapshot
+    # is made for this one resolution, so nothing priced from live calls outlives it.
+    if prices is None:
+        prices = PriceSnapshot()
+    memo_dict = prices.resolved_item_dict
+
+    key = (item_id, relevant_skip_set(item_id, skip_set))
+    if key in memo_dict:
+        cost, ingredient_dict = memo_dict[key]
+        return cost, ingredient_dict, False
+
+    if item_id in skip_set:
+        memo_dict[key] = (0, {item_id: 1})
+        return 0, {item_id: 1}, False
+
+    if in_progress is None:
+        in_progress = set()
+    if item_id in in_progress:
+        return float('inf'), {}, True
+    in_progress.add(item_id)
+
+    best_cost = get_item_price(item_id=item_id, listing_type='sells', prices=prices)
+    best_ingredient_dict = {item_id: 1}
+    cycle = False
+    for recipe_id in get_recipe_output(item_id=item_id) or []:
+        recipe_dict = parse_recipe(recipe_id=recipe_id)
+        recipe_cost, recipe_ingredient_dict, recipe_cycle = resolve_recipe(recipe_dict=recipe_dict, skip_set=skip_set, in_progress=in_progress, prices=prices)
+        cycle = cycle or recipe_cycle
+
+        output_quantity = recipe_dict['output_item_count']
+        if recipe_cost / output_quantity < best_cost:
+            best_cost = recipe_cost / output_quantity
+            best_ingredient_dict = {ingredient_id: quantity / output_quantity for ingredient_id, quantity in recipe_ingredient_dict.items()}
+
+    in_progress.discard(item_id)
+    if not cycle:
+        memo_dict[key] = (best_cost, best_ingredient_dict)
+
+    return best_cost, best_ingredient_dict, cycle
+
+
+def resolve_recipe(recipe_dict, skip_set=frozenset(), in_progress=None, prices=None):
+    # cost of one craft of the recipe with every ingredient resolved, and the base ingredients that adds up to.
+    if prices is None:
+        prices = PriceSnapshot()
+    recipe_cost = 0
+    recipe_ingredient_dict = {}
+    cycle = False
+    for ingredient in recipe_dict['ingredients']:
+        item_cost, item_ingredient_dict, item_cycle = resolve_item(item_id=ingredient['item_id'], skip_set=skip_set, in_progress=in_progress, prices=prices)
+        cycle = cycle or item_cycle
+        recipe_cost += item_cost * ingredient['count']
+        for base_item_id, base_quantity in item_ingredient_dict.items():
+            recipe_ingredient_dict[base_item_id] = recipe_ingredient_dict.get(base_item_id, 0) + base_quantity * ingredient['count']
+
+    return recipe_cost, recipe_ingredient_dict, cycle
+
+
+def compare_item_to_ingredients(item, skip_list=[], prices=None):
+    item_cost, item_ingredient_dict, cycle = resolve_item(item_id=item['item_id'], skip_set=frozenset(skip_list), prices=prices)
+    return {item_id: quantity * item['count'] for item_id, quantity in item_ingredient_dict.items()}
+
+
+def base_recipe_list(recipe_input, skip_list=[], prices=None):
     if isinstance(recipe_input, int):
         recipe_dict = parse_recipe(recipe_id=recipe_input)
     elif isinstance(recipe_input, dict):
         recipe_dict = recipe_input
-    ingredient_list = recipe_dict['ingredients']
-
-    cleaned_ingredient_dict = {}
-    for item in ingredient_list:
-        single_item_dict = compare_item_to_ingredients(item=item, skip_list=skip_list)
-        for item_id, quantity in single_item_dict.items():
-            if item_id in cleaned_ingredient_dict:
-                cleaned_ingredient_dict[item_id] += quantity
-            else:
-                cleaned_ingredient_dict[item_id] = quantity
 
+    recipe_cost, cleaned_ingredient_dict, cycle = resolve_recipe(recipe_dict=recipe_dict, skip_set=frozenset(skip_list), prices=prices)
     return cleaned_ingredient_dict
 
 
-def get_recipe_profit_from_id(recipe_id, min_profit=0):
+def get_recipe_profit_from_id(recipe_id, min_profit=0, prices=None):
     recipe_dict = parse_recipe(recipe_id=recipe_id)
     output_item_id = recipe_dict['output_item_id']
     output_quantity = recipe_dict['output_item_count']
-    output_sale_price = get_item_price(item_id=output_item_id, listing_type='buys') * output_quantity
+    output_sale_price = get_item_price(item_id=output_item_id, listing_type='buys', prices=prices) * output_quantity
 
     if output_sale_price >= min_profit:
-        ingredient_dict = base_recipe_list(recipe_input=recipe_dict)
-        ingredient_price = get_recipe_price(ingredient_dict=ingredient_dict)
+        ingredient_dict = base_recipe_list(recipe_input=recipe_dict, prices=prices)
+        ingredient_price = get_recipe_price(ingredient_dict=ingredient_dict, prices=prices)
         result = output_sale_price - ingredient_price
     else:
         result = -float('inf')
@@ -251,25 +367,69 @@ def get_recipe_profit_from_id(recipe_id, min_profit=0):
     return result
 
 
-def get_recipe_profit_from_dicts(recipe_dict, ingredient_dict, skip_list=[], min_profit=0):
+def get_recipe_profit_from_dicts(recipe_dict, ingredient_dict, skip_list=[], min_profit=0, prices=None):
     output_item_id = recipe_dict['output_item_id']
     output_quantity = recipe_dict['output_item_count']
-    output_sale_price = get_item_price(item_id=output_item_id, listing_type='buys') * output_quantity
+    output_sale_price = get_item_price(item_id=output_item_id, listing_type='buys', prices=prices) * output_quantity
 
     if output_sale_price >= min_profit:
-        ingredient_price = get_recipe_price(ingredient_dict=ingredient_dict, skip_list=skip_list)
+        ingredient_price = get_recipe_price(ingredient_dict=ingredient_dict, skip_list=skip_list, prices=prices)
         result = output_sale_price - ingredient_price
     else:
         result = -float('inf')
 
     return result
 
-def get_profitable_recipes(recipes_list, min_profit=1000, verbose=False):
+def init_scoring_worker(prices, recipe_dict_by_id, recipe_list_by_output):
+    # runs once in each worker process. everything scoring needs is handed over here, so workers never go to the
+    # network or share the parent's cache connection.
+    global worker_prices
+    gw2api.cache_db = None
+    worker_prices = prices
+    recipe_details_dict.update(recipe_dict_by_id)
+    recipe_output_dict.update(recipe_list_by_output)
+
+
+def score_recipe_chunk(recipe_id_list, min_profit):
+    return [(recipe_id, get_recipe_profit_from_id(recipe_id, min_profit=min_profit, prices=worker_prices)) for recipe_id in recipe_id_list]
+
+
+def iter_profitable_recipes(recipes_list, min_profit=1000, prices=None, workers=None, chunk_size=50):
+    # scores recipes across a process pool and yields (recipe_id, profit) for the profitable ones as workers finish,
+    # so results come back in completion order rather than list order.
+    item_id_set = collect_recipe_item_ids(get_recipes_bulk(recipes_list))
+    if prices is None:
+        prices = PriceSnapshot(item_ids=item_id_set)
+    else:
+        prices.fetch(item_id_set)
+
+    init_arguments = (prices, recipe_details_dict, recipe_output_dict)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_scoring_worker, initargs=init_arguments) as executor:
+        futures = [executor.submit(score_recipe_chunk, chunk, min_profit) for chunk in gw2api.chunk_list(recipes_list, size=chunk_size)]
+        for future in as_completed(futures):
+            for recipe_id, profit in future.result():
+                if profit > min_profit and not profit == float('inf'):
+                    yield recipe_id, profit
+
+
+def get_profitable_recipes(recipes_list, min_profit=1000, verbose=False, prices=None, workers=1):
+    # with more than one worker the recipes are scored in parallel and the result is a new dict rather than
+    # profitable_recipes_dict. output still happens here, in the parent process.
+    if prices is None:
+        prices = PriceSnapshot(item_ids=collect_recipe_item_ids(get_recipes_bulk(recipes_list)))
+
+    if workers is None or workers > 1:
+        parallel_profitable_recipes_dict = {}
+        for recipe_id, profit in iter_profitable_recipes(recipes_list, min_profit=min_profit, prices=prices, workers=workers):
+            parallel_profitable_recipes_dict[recipe_id] = profit
+            output_recipe({'recipe': recipe_id}, prices=prices)
+        return parallel_profitable_recipes_dict
+
     for recipe_id in recipes_list:
-        profit = get_recipe_profit_from_id(recipe_id, min_profit=min_profit)
+        profit = get_recipe_profit_from_id(recipe_id, min_profit=min_profit, prices=prices)
         if profit > min_profit and not profit == float('inf') and not profit == -float('inf'):
             profitable_recipes_dict[recipe_id] = profit
-            output_recipe({recipe_id: profit})
+            output_recipe({'recipe': recipe_id}, prices=prices)
             profitable_recipes_dict[recipe_id] = profit
         elif verbose:
             print('''--------------------------
@@ -279,7 +439,58 @@ not profitable'''.format(recipe=recipe_id))
     return profitable_recipes_dict
 
 
-def output_recipe(profit_dict, force_output=False):
+def top_recipes(recipes_list, k=50, rank_by='profit', discipline=None, needs_recipe=None, prices=None):
+    # the k best recipes in recipes_list as (score, recipe_id, profit), best first. rank_by is profit, roi or
+    # profit_per_hour (from the recipe's own crafting time). a bounded heap holds the k best so far, and a recipe whose
+    # output sells for less than the k-th best score could ever come to is never resolved: revenue is the most a
+    # recipe can make, so it bounds profit directly and profit per hour once divided by the crafting time.
+    assert rank_by in ('profit', 'roi', 'profit_per_hour')
+    if prices is None:
+        prices = PriceSnapshot(item_ids=collect_recipe_item_ids(get_recipes_bulk(recipes_list)))
+
+    heap = []       # (score, recipe_id, profit), worst of the best k on top
+    for recipe_id in recipes_list:
+        recipe_dict = parse_recipe(recipe_id=recipe_id)
+        if discipline is not None and discipline not in recipe_dict.get('disciplines', []):
+            continue
+        if needs_recipe is not None and ('LearnedFromItem' in recipe_dict.get('flags', [])) != needs_recipe:
+            continue
+
+        hours = recipe_dict.get('time_to_craft_ms', 0) / 3600000
+        if rank_by == 'profit_per_hour' and not hours:
+            continue
+
+        # the revenue needed to possibly beat the k-th best, -inf while the heap is still filling.
+        min_revenue = -float('inf')
+        if len(heap) == k and rank_by == 'profit':
+            min_revenue = heap[0][0]
+        elif len(heap) == k and rank_by == 'profit_per_hour':
+            min_revenue = heap[0][0] * hours
+
+        profit = get_recipe_profit_from_id(recipe_id, min_profit=min_revenue, prices=prices)
+        if profit == -float('inf') or profit == float('inf') or profit != profit:
+            continue
+
+        if rank_by == 'profit':
+            score = profit
+        elif rank_by == 'profit_per_hour':
+            score = profit / hours
+        else:
+            output_sale_price = get_item_price(item_id=recipe_dict['output_item_id'], listing_type='buys', prices=prices) * recipe_dict['output_item_count']
+            cost = output_sale_price - profit
+            if cost <= 0:
+                continue
+            score = profit / cost
+
+        if len(heap) < k:
+            heapq.heappush(heap, (score, recipe_id, profit))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, recipe_id, profit))
+
+    return sorted(heap, reverse=True)
+
+
+def output_recipe(profit_dict, force_output=False, prices=None):
     output_string = '''--------------------------
 Recipe ID: {recipe}
 Item: {name}
@@ -297,16 +508,16 @@ ROI: {roi:.3%}'''
 
     recipe_dict = parse_recipe(recipe_id)
     output_item_id = recipe_dict['output_item_id']
-    output_item_price = get_item_price(item_id=output_item_id, listing_type='buys')
+    output_item_price = get_item_price(item_id=output_item_id, listing_type='buys', prices=prices)
 
     if ingredients_dict is None:
-        ingredients_dict = base_recipe_list(recipe_id)
+        ingredients_dict = base_recipe_list(recipe_id, prices=prices)
     ingredients_string = ''
     ingredients_price = 0
 
     if recipe_id:   # if this is None, it means we're just selling the item, and thus there's no ingredients and they cost nothing.
         for temp_id, temp_quantity in ingredients_dict.items():
-            temp_price = get_item_price(item_id=temp_id, listing_type='sells')
+            temp_price = get_item_price(item_id=temp_id, listing_type='sells', prices=prices)
             temp_total = temp_price * temp_quantity
             ingredients_price += temp_total
             temp_item_dict = parse_item(item_id=temp_id)
@@ -350,70 +561,167 @@ def format_prices(price):
     return price_string
 
 
+def build_used_in_index(recipe_dict_list=None):
+    # reverse index from every item to the recipes that take it as an ingredient. with no list every recipe is
+    # fetched, 200 at a time, and since that covers every output recipe_output_dict is complete afterwards too.
+    global recipe_output_complete
+    if recipe_dict_list is None:
+        recipe_dict_list = get_recipes_bulk(api_query(payload='', api_endpoint='recipe_details') or [])
+        recipe_output_dict.clear()
+        recipe_output_complete = True
+
+    used_in_dict.clear()
+    successor_dict.clear()
+    successor_output_dict.clear()
+    for recipe_dict in recipe_dict_list:
+        recipe_details_dict[recipe_dict['id']] = recipe_dict
+        if recipe_output_complete:
+            recipe_output_dict.setdefault(recipe_dict['output_item_id'], []).append(recipe_dict['id'])
+        for ingredient in recipe_dict['ingredients']:
+            recipe_count_dict = used_in_dict.setdefault(ingredient['item_id'], {})
+            recipe_count_dict[recipe_dict['id']] = recipe_count_dict.get(recipe_dict['id'], 0) + ingredient['count']
+
+
+def successor_recipes(item_id, in_progress=None):
+    # every recipe that uses the item, directly or by way of crafting something from it, as {recipe_id: how many of
+    # the item one craft takes}, counted along whichever route takes the most. returns (that dict, cycle), results
+    # cut short by a loop of convertible materials aren't memoised, same as resolve_item.
+    if item_id in successor_dict:
+        return successor_dict[item_id], False
+
+    if in_progress is None:
+        in_progress = set()
+    if item_id in in_progress:
+        return {}, True
+    in_progress.add(item_id)
+
+    successors = {}
+    cycle = False
+    for recipe_id, count in used_in_dict.get(item_id, {}).items():
+        successors[recipe_id] = max(successors.get(recipe_id, 0), count)
+        recipe_dict = recipe_details_dict[recipe_id]
+        per_output = count / recipe_dict['output_item_count']
+        next_successors, next_cycle = successor_recipes(recipe_dict['output_item_id'], in_progress=in_progress)
+        cycle = cycle or next_cycle
+        for next_recipe_id, next_count in next_successors.items():
+            successors[next_recipe_id] = max(successors.get(next_recipe_id, 0), next_count * per_output)
+
+    in_progress.discard(item_id)
+    if not cycle:
+        successor_dict[item_id] = successors
+
+    return successors, cycle
+
+
 def get_all_successor_recipes_from_item(item_id):
-    stage_one_recipe_list = api_query(payload=item_id, api_endpoint='recipes_input')
-    master_recipe_set = set(get_all_successor_recipes_from_recipe_list(stage_one_recipe_list))
-    return list(master_recipe_set)
+    if not used_in_dict:
+        build_used_in_index()
 
+    return list(successor_recipes(item_id)[0])
 
-def get_all_successor_recipes_from_recipe_list(recipe_list, verbose=False):
-    if not recipe_list:
-        return []
-    else:
-        master_recipe_set = set(recipe_list)
 
-        if verbose:
-            print('\ncurrent set: {recipe_set}'.format(recipe_set=master_recipe_set))
-        for recipe_id in recipe_list:
-            recipe_dict = api_query(payload=recipe_id, api_endpoint='recipe_details')
-            output_item_id = recipe_dict['output_item_id']
-            current_tier_recipe_list = api_query(payload=output_item_id, api_endpoint='recipes_input')
-            master_recipe_set.update(current_tier_recipe_list)
+def get_all_successor_recipes_from_recipe_list(recipe_list, verbose=False):
+    if not used_in_dict:
+        build_used_in_index()
 
-            if verbose:
-                print('recipe {recipe_id}: will add {current_list} to set. beginning recursion.'.format(recipe_id=recipe_id, current_list=current_tier_recipe_list))
+    master_recipe_set = set(recipe_list)
+    visited_item_set = set()
+    for recipe_id in recipe_list:
+        output_item_id = parse_recipe(recipe_id=recipe_id)['output_item_id']
+        if output_item_id in visited_item_set:
+            continue
+        visited_item_set.add(output_item_id)
 
-            next_tier_recipe_list = get_all_successor_recipes_from_recipe_list(recipe_list=current_tier_recipe_list)
-            master_recipe_set.update(next_tier_recipe_list)
+        current_successor_list = successor_recipes(output_item_id)[0]
+        master_recipe_set.update(current_successor_list)
+        if verbose:
+            print('recipe {recipe_id}: adds {count} successors.'.format(recipe_id=recipe_id, count=len(current_successor_list)))
 
-        return list(master_recipe_set)
+    return list(master_recipe_set)
 
 
-def best_recipe_for_item(item_id, target_item_id=None, recursion_depth=0, skip_list=[], verbose=True):
+def best_recipe_for_item(item_id, target_item_id=None, skip_list=[], verbose=True, prices=None):
+    # every recipe downstream of item_id whose cheapest resolution, with target_item_id taken from stock, still uses
+    # target_item_id. the recipes come from the local used-in index, and resolutions are memoised on the snapshot.
     if target_item_id is None:
         target_item_id = item_id
+    if not used_in_dict:
+        build_used_in_index()
 
-    best_list = []
-
+    successors = successor_recipes(item_id)[0]
     if verbose:
-        recursion_buffer = '\t' * recursion_depth
-        item_name = api_query(payload=item_id, api_endpoint='item_details').get('name')
-        print('{recurse}{item_name}'.format(item_name=item_name, recurse=recursion_buffer))
-
-    recipe_list = api_query(payload=item_id, api_endpoint='recipes_input')
+        item_name = parse_item(item_id=item_id).get('name')
+        print('{item_name}: {count} recipes use it'.format(item_name=item_name, count=len(successors)))
 
-    for recipe_id in recipe_list:
-        recipe_dict = api_query(payload=recipe_id, api_endpoint='recipe_details')
-        output_item_id = recipe_dict['output_item_id']
-        intermediate_skip_list = skip_list.copy()
-        intermediate_skip_list.append(item_id)
-        recipe_ingredient_dict = base_recipe_list(recipe_input=recipe_dict, skip_list=intermediate_skip_list)
+    if prices is None:
+        prices = PriceSnapshot(item_ids=collect_recipe_item_ids([recipe_details_dict[recipe_id] for recipe_id in successors]))
 
-        target_item_count = recipe_ingredient_dict.get(target_item_id, 0)
-        if target_item_count > 0:
+    skip_set = frozenset(skip_list) | {target_item_id}
+    best_list = []
+    for recipe_id in sorted(successors):
+        recipe_ingredient_dict = base_recipe_list(recipe_input=recipe_details_dict[recipe_id], skip_list=skip_set, prices=prices)
+        if recipe_ingredient_dict.get(target_item_id, 0) > 0:
             best_list.append({'recipe': recipe_id, 'ingredients': recipe_ingredient_dict})
 
-        if verbose:
-            print('{recurse}recursion beginning!'.format(recurse=recursion_buffer))
-        recursion = best_recipe_for_item(item_id=output_item_id, target_item_id=target_item_id, recursion_depth=recursion_depth+1, skip_list=skip_list)
+    return best_list
+
 
-        if recursion:
-            best_list.extend(recursion)
+def get_material_storage(api=''):
+    # the account's material storage as {item_id: count}, empty slots left out.
+    assert isinstance(api, str)
 
+    material_list = api_query(payload=api, api_endpoint='account_materials') or []
+    return {material['id']: material['count'] for material in material_list if material['count'] > 0}
+
+
+def best_use_for_inventory(inventory_dict, prices=None, verbose=False):
+    # best thing to do with each stack of an inventory ({item_id: quantity}): sell it to the buy orders, or craft the
+    # recipe that gets the most out of each unit, with the leftovers sold. every stack is judged against one price
+    # snapshot covering all their successor recipes, so subtrees shared between materials are fetched, priced and
+    # resolved once. returns {item_id: {'action', 'recipe', 'ingredients', 'crafts', 'unit_value', 'value'}}.
+    if not used_in_dict:
+        build_used_in_index()
+
+    successors_by_item = {item_id: successor_recipes(item_id)[0] for item_id in inventory_dict}
+    recipe_id_set = set()
+    for successors in successors_by_item.values():
+        recipe_id_set.update(successors)
+    item_id_set = collect_recipe_item_ids([recipe_details_dict[recipe_id] for recipe_id in recipe_id_set]) | set(inventory_dict)
+    if prices is None:
+        prices = PriceSnapshot(item_ids=item_id_set)
+    else:
+        prices.fetch(item_id_set)
+
+    best_use_dict = {}
+    for item_id, quantity in inventory_dict.items():
+        sell_price = max(get_item_price(item_id=item_id, listing_type='buys', prices=prices), 0)    # unsellable stacks are just kept
+        best_use = {'action': 'sell', 'recipe': None, 'ingredients': None, 'crafts': 0, 'unit_value': sell_price, 'value': sell_price * quantity}
+
+        skip_set = frozenset([item_id])
+        for recipe_id in successors_by_item[item_id]:
+            recipe_dict = recipe_details_dict[recipe_id]
+            ingredient_dict = base_recipe_list(recipe_input=recipe_dict, skip_list=skip_set, prices=prices)
+            units_used = ingredient_dict.get(item_id, 0)
+            if units_used <= 0 or units_used > quantity:
+                continue
+
+            profit = get_recipe_profit_from_dicts(recipe_dict=recipe_dict, ingredient_dict=ingredient_dict, skip_list=skip_set, min_profit=-float('inf'), prices=prices)
+            if profit in (float('inf'), -float('inf')) or profit != profit:
+                continue
+
+            unit_value = profit / units_used
+            if unit_value > best_use['unit_value']:
+                crafts = int(quantity // units_used)
+                best_use = {
+                    'action': 'craft', 'recipe': recipe_id, 'ingredients': ingredient_dict, 'crafts': crafts, 'unit_value': unit_value,
+                    'value': crafts * profit + (quantity - crafts * units_used) * sell_price
+                }
+
+        best_use_dict[item_id] = best_use
         if verbose:
-            print('{recurse}recursion ending!'.format(recurse=recursion_buffer))
+            print('{item_id}: {action} {quantity} for {value}'.format(item_id=item_id, action=best_use['action'], quantity=quantity, value=format_prices(best_use['value'])))
 
-    return best_list
+    return best_use_dict
 
 
 def testing(function_to_test, function_input=None, expected=None):
@@ -555,12 +863,18 @@ if __name__ == '__main__':
     84696,
     83195
   ]
-    for main_item_id in material_storage:
-
+    if api_key:
+        inventory_dict = get_material_storage(api=api_key)
+    else:   # no key to read the account with, so judge one of each
+        inventory_dict = {item_id: 1 for item_id in material_storage}
+
+    prices = PriceSnapshot()
+    best_use_dict = best_use_for_inventory(inventory_dict, prices=prices)
+    for main_item_id, best_use in best_use_dict.items():
         item_dict = parse_item(item_id=main_item_id)
         name = item_dict['name']
-        print('{}:'.format(name.upper()))
-        best_profit_list = best_recipe_for_item(item_id=main_item_id, skip_list=[main_item_id], verbose=True)
-        for recipe_dict in best_profit_list:
-            output_recipe(best_profit_dict)
+        print('{name}: {action} ({value})'.format(name=name.upper(), action=best_use['action'], value=format_prices(best_use['value'])))
+        if best_use['recipe'] is not None:
+            output_recipe({'recipe': best_use['recipe'], 'ingredients': best_use['ingredients']}, force_output=True, prices=prices)
 
+    metrics.export()
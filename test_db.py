@@ -0,0 +1,86 @@
+import records
+
+import db
+
+
+def legacy_database(path, chain_length=30):
+    # recipes table as the first version of db.py created it: a chain where item k + 1 is crafted from two of item k,
+    # plus the one-step alternates an older alternate recipe pass added for it.
+    db.db = records.Database(db_url='sqlite:///' + str(path))
+    db.verbose = False
+    db.db.query("""CREATE TABLE recipes (
+    game_id INTEGER NOT NULL,
+    is_altered INTEGER,
+    unique_id INTEGER PRIMARY KEY,
+    needs_recipe INTEGER,
+    output_item INTEGER NOT NULL,
+    output_quantity INTEGER NOT NULL,
+    component_string TEXT NOT NULL
+);""")
+
+    recipe_row_list = []
+    for game_id in range(1, chain_length + 1):
+        recipe_row_list.append({
+            'game_id': game_id, 'is_altered': 0, 'unique_id': db.generate_unique_id(recipe_id=game_id, size=7), 'output_item': game_id + 1,
+            'component_string': db.component_to_string(item_id=game_id, count=2)
+        })
+    for game_id in range(2, chain_length + 1):
+        recipe_row_list.append({
+            'game_id': game_id, 'is_altered': 1, 'output_item': game_id + 1, 'component_string': db.component_to_string(item_id=game_id - 1, count=4),
+            'unique_id': db.generate_unique_id(db.generate_unique_id(recipe_id=game_id, size=7), db.generate_unique_id(recipe_id=game_id - 1, size=7), size=7)
+        })
+    db.db.bulk_query("""INSERT INTO recipes (game_id, is_altered, unique_id, needs_recipe, output_item, output_quantity, component_string)
+VALUES (:game_id, :is_altered, :unique_id, 0, :output_item, 1, :component_string);""", recipe_row_list)
+
+
+def migrate():
+    # the migration steps of db.py's main block, in order.
+    db.index_recipe_ingredients()
+    db.migrate_component_blobs()
+    db.migrate_content_hashes()
+    db.migrate_expansion_depth()
+    db.migrate_recipe_details()
+    db.migrate_discipline_steps()
+
+
+def test_migrated_alternates_are_not_expanded_again(tmp_path):
+    legacy_database(tmp_path / 'legacy.db')
+    migrate()
+
+    depth_row_list = db.db.query('SELECT is_altered, expansion_depth FROM recipes;').all()
+    assert all(depth == (db.fully_expanded_depth if is_altered else 0) for is_altered, depth in depth_row_list)
+
+    # every base pair is already a legacy alternate, and the legacy alternates themselves are left alone.
+    assert db.alternate_recipes(max_depth=3, pruning='none') == 0
+
+
+def test_component_blobs_are_little_endian():
+    component_blob = db.pack_components([{'item_id': 3, 'count': 2}, {'item_id': 1, 'count': 70000}])
+    assert component_blob == bytes.fromhex('01000000' '03000000' '70110100' '02000000')
+    assert [list(values) for values in db.unpack_components(component_blob)] == [[1, 3], [70000, 2]]
+
+
+def test_ingredients_are_priced_at_the_cheaper_of_buying_and_crafting(tmp_path):
+    # ore buys for 10, an ingot buys for 100 or crafts from two ore, a sword crafts from three ingots and sells for 1000.
+    db.db = records.Database(db_url='sqlite:///' + str(tmp_path / 'prices.db'))
+    db.verbose = False
+    db.init_items()
+    db.init_recipes()
+    db.db.bulk_query('INSERT INTO items (item_id, name, tp_cost, tp_value) VALUES (:item_id, :name, :tp_cost, :tp_value);', [
+        {'item_id': 1, 'name': 'ore', 'tp_cost': 10, 'tp_value': 8},
+        {'item_id': 2, 'name': 'ingot', 'tp_cost': 100, 'tp_value': 90},
+        {'item_id': 3, 'name': 'sword', 'tp_cost': 1200, 'tp_value': 1000},
+    ])
+    recipe_row_list = [
+        {'game_id': 1, 'is_altered': 0, 'unique_id': 1, 'output_item': 2, 'output_quantity': 1, 'needs_recipe': 0,
+         'component_blob': db.pack_components([{'item_id': 1, 'count': 2}])},
+        {'game_id': 2, 'is_altered': 0, 'unique_id': 2, 'output_item': 3, 'output_quantity': 1, 'needs_recipe': 0,
+         'component_blob': db.pack_components([{'item_id': 2, 'count': 3}])},
+    ]
+    with db.db.transaction():
+        db.insert_recipes(recipe_row_list)
+    db.init_views()
+
+    output_dict = db.best_recipe_by_recipe_list(db.db.query('SELECT * FROM recipes WHERE game_id = 2;').as_dict())
+    assert output_dict['raw_profit'] == 1000 - 3 * 2 * 10
+    assert output_dict['raw_method'][0]['type'] == 'craft' and output_dict['raw_method'][0]['method'] == 'recipe 1'
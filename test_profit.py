@@ -0,0 +1,19 @@
+import db
+import profit
+
+
+def test_batch_sizing_with_unlimited_cost_levels():
+    # load_ladders ends a vendor-backed ingredient's cost ladder in an unlimited level, and gives an ingredient with no
+    # order book a single unlimited level. neither may cap the batch.
+    recipe_dict = {'output_item': 3, 'output_quantity': 1, 'component_blob': db.pack_components([{'item_id': 1, 'count': 2}, {'item_id': 2, 'count': 1}])}
+    ladder_dict = {
+        1: (profit.Ladder([10, 12, 15], [5, 5, float('inf')]), profit.Ladder([8], [float('inf')])),     # book backed by a vendor
+        2: (profit.Ladder([20], [float('inf')]), profit.Ladder([0], [float('inf')])),                  # no book
+        3: (profit.Ladder([200], [float('inf')]), profit.Ladder([100, 90, 60, 5], [3, 4, 10, float('inf')])),
+    }
+
+    def batch_profit(crafts):
+        cost, revenue = profit.batch_totals(recipe_dict, crafts, ladder_dict)
+        return revenue - cost
+
+    assert profit.max_profitable_crafts(recipe_dict, ladder_dict) == max(range(profit.max_batch + 1), key=batch_profit)